@@ -9,12 +9,20 @@ v1.0
 
 import serial
 import subprocess as sp
+import collections
+import contextlib
 import json   
+import threading
+import time
+import numpy as np
 
+from clock import monotonic
+from ringbuffer import RingBuffer
+from serial_loop import LoopDevice
 
 
 
-class WindFreakUsb2(object):
+class WindFreakUsb2(LoopDevice):
     """
     The first character of any communication to the SynthUSBii unit is the command.  (It is 
     case sensitive.)  What this character tells the unit to do is detailed below. Ideally a 
@@ -56,11 +64,14 @@ class WindFreakUsb2(object):
     carriage return at the end.
     """
     baudrate = 115200
-        
-    def __init__(self, port):
-        self.serial = self._open_port(port)
-        self._serial_write(b'+\n')# flush io buffer
-        print (self._serial_read()) #will read unknown command
+    SWEEP_BATCH = 16    # COUNTS? per write in sweep_counts
+        
+    def __init__(self, port, loop=None):
+        if loop is None:
+            self.serial = self._open_port(port)
+        else:
+            self.serial = self._open_channel(loop, port, '\n', 1.)
+        print (self._query('+')) #will read unknown command
         self.set_clock(1)
         
         
@@ -80,64 +91,116 @@ class WindFreakUsb2(object):
         return msg_string
         
     def get_freq(self):
-        self._serial_write('f?')
-        return self._serial_read()
+        return self._query('f?')
     
     def rf_on(self):
-        self._serial_write('o1')
-        return self._serial_read()
+        return self._query('o1')
     
     def rf_off(self):
-        self._serial_write('o0')
-        return self._serial_read()
+        return self._query('o0')
     
     def rf_power_low(self):
-        self._serial_write('h0')
+        self._send('h0')
     
     def rf_power_high(self):
-        self._serial_write('h1')
+        self._send('h1')
     
     def set_pulse_mode(self,value):
-        self._serial_write('j' + str(value))
+        self._send('j' + str(value))
     
     def get_pulse_mode(self):
-        self._serial_write('j?')
-        return self._serial_read()
+        return self._query('j?')
         
     def get_power(self):
-        self._serial_write('a?')
-        return self._serial_read()
+        return self._query('a?')
         
     def set_freq(self,value):
-        self._serial_write('f' + str(value))
-        return self._serial_read()
+        return self._query('f' + str(value))
         
     def check_osci(self):
-        self._serial_write('p')
-        return self._serial_read()
+        return self._query('p')
     
     def set_clock(self,value):
-        self._serial_write('x' + str(value))
-        return self._serial_read()
+        return self._query('x' + str(value))
     
     def get_clock(self):
-        self._serial_write('x?')
-        return self._serial_read()
+        return self._query('x?')
     
     def set_power(self,value):
-        self._serial_write('a' + str(value))
-        return self._serial_read()
+        return self._query('a' + str(value))
+
+    def sweep_points(self,lower,upper,step):
+        # Frequencies (MHz) the sweep goes through
+        return lower + step * np.arange(int(round((upper - lower) / step)) + 1)
+
+    def sweep(self,lower,upper,step,step_time,continuous=False):
+        # Hardware sweep from lower to upper MHz in steps of step MHz, step_time ms each,
+        # all the registers and the start in one write. Returns the duration of one sweep (s)
+        self._send_pipelined(['g0', 'l%.3f' % lower, 'u%.3f' % upper, 's%.3f' % step,
+                              't%.3f' % step_time, 'c%d' % bool(continuous), 'g1'])
+        return len(self.sweep_points(lower, upper, step)) * step_time / 1000.
+
+    def stop_sweep(self):
+        self._send('g0')
+
+    def sweep_counts(self,counter,lower,upper,step,step_time,gate_time=None,latency=0.,slack=0.1):
+        # One sweep with the counter gating back to back alongside it: all the COUNTS? go out
+        # in one write right after the sweep starts. Every gate is placed in time from when its
+        # reply came (minus latency, s) relative to the start of the sweep, and goes to the step
+        # holding its middle; gates spilling more than slack (fraction of the gate) out of that
+        # step are dropped, since the gates drift against the steps (dead time between gates,
+        # start offset). gate_time (whole ms, at most step_time) defaults to half the step time,
+        # so that most steps hold a clean gate. Returns the frequencies (MHz), the mean counts per gate of
+        # every step (a column per counter channel, NaN without a clean gate) and the number
+        # of clean gates of every step. A missing or short reply raises IOError/ValueError
+        from Counter import parse_counts
+        gate_time = max(int(step_time) // 2, 1) if gate_time is None else gate_time
+        if gate_time < 1 or gate_time != int(gate_time) or gate_time > step_time:
+            raise ValueError('The counter needs a gate time of a whole number of ms, at most the step time')
+        frequencies = self.sweep_points(lower, upper, step)
+        dwell, gate = step_time / 1000., gate_time / 1000.
+        # Enough gates to cover the whole sweep even with some dead time between them
+        n_gates = int(np.ceil(len(frequencies) * dwell / gate * (1 + slack))) + 1
+        counter.set_gate_time(gate_time)
+        self.sweep(lower, upper, step, step_time)
+        start = monotonic()
+        # In batches, so that without a loop the replies are read while the gates run
+        replies = []
+        for first in range(0, n_gates, self.SWEEP_BATCH):
+            batch = ['COUNTS?'] * min(self.SWEEP_BATCH, n_gates - first)
+            replies.extend(counter._query_pipelined(batch, n_gates * gate * (1 + slack) + 1.))
+        rows = []
+        for reply in replies:
+            text = reply.result()
+            if not text:
+                raise IOError('No reply to COUNTS? during the sweep')
+            counts = parse_counts(text)
+            if len(counts) == 0 or (rows and len(counts) != len(rows[0])):
+                raise ValueError('Counter reply too short: ' + repr(text))
+            rows.append(counts)
+        self.stop_sweep()
+        counts = np.array(rows)
+        ends = np.array([reply.time for reply in replies]) - latency - start
+        middles = ends - gate / 2
+        steps = np.floor(middles / dwell).astype(int)
+        inside = np.minimum(ends, (steps + 1) * dwell) - np.maximum(ends - gate, steps * dwell)
+        clean = (steps >= 0) & (steps < len(frequencies)) & (inside >= (1 - slack) * gate)
+        gates = np.bincount(steps[clean], minlength=len(frequencies))
+        sums = np.zeros((len(frequencies), counts.shape[1]))
+        np.add.at(sums, steps[clean], counts[clean])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / gates[:, None]
+        return frequencies, means, gates
     
     def serial_number(self):
-        self._serial_write('+')
-        return self._serial_read()
+        return self._query('+')
         
     def close(self):
-        self.serial.close()
+        self._close()
         
 
         
-class AnalogComm(object):
+class AnalogComm(LoopDevice):
 # Module for communicating with the mini usb IO board
     """
     Mini analog IO unit.
@@ -166,10 +229,14 @@ class AnalogComm(object):
     from 0V to 4.095V.                                                              
     """
     baudrate = 115200
-    def __init__(self, port):
-        self.serial = self._open_port(port)
-        self._serial_write('*IDN?')# flush io buffer
-        print (self._serial_read()) #will read a command
+    separator = ';'
+    inputs = 4      # IN? channels, all of them in an ALLIN? reply
+    def __init__(self, port, loop=None):
+        if loop is None:
+            self.serial = self._open_port(port)
+        else:
+            self.serial = self._open_channel(loop, port, ';', 0.5)
+        print (self._query('*IDN?')) #will read a command
         self.reset() #Resets device so correct voltages read
         
     
@@ -189,36 +256,189 @@ class AnalogComm(object):
         return msg_string
     
     def reset(self):
-        self._serial_write('*RST')
-        return self._serial_read()
+        return self._query('*RST')
         
     def get_voltage(self,channel):
-        self._serial_write('IN?' + str(channel))
-        voltage = self._serial_read()
+        voltage = self._query('IN?' + str(channel))
         return voltage
         
     def get_voltage_all(self):
-        self._serial_write('ALLIN?')
-        allin = self._serial_read()
+        allin = self._query('ALLIN?')
         return allin
+
+    def get_voltages(self,channels):
+        # The inputs of several channels in one round trip (IN?0;IN?1;...)
+        replies = self._query_pipelined(['IN?' + str(channel) for channel in channels])
+        return [reply.result() for reply in replies]
     
     
     def set_voltage(self,channel,value):
-        self._serial_write('OUT'+ str(channel) + str(value))
+        self._send('OUT'+ str(channel) + str(value))
         return 
     
     def set_digitout(self,value):
-        self._serial_write('DIGOUT' + str(value))
+        self._send('DIGOUT' + str(value))
         return
     
     def close(self): 
-        self.serial.close()
+        self._close()
 
     def serial_number(self):
-        self._serial_write(b'*IDN?')
-        return self._serial_read()
+        return self._query('*IDN?')
+
+
+def parse_allin(reply):
+    # The voltages of an ALLIN? reply (separated by spaces or commas) as a float array
+    return np.fromstring(reply.replace(',', ' '), dtype=float, sep=' ')
+
+
+class AnalogSampler(object):
+    """
+    Back-to-back ALLIN? readings of an AnalogComm, as fast as the board
+    answers: PIPELINE_DEPTH requests stay in flight, and every reply (all
+    the inputs at once) goes into raw, a ring buffer with one column per
+    input, timestamped when it arrived.
+
+    decimation gives a factor per input (or one for all): every BATCH
+    samples, the new samples of each input are averaged in blocks of its
+    factor, in one go, into outputs[input] (a ring buffer per input, each
+    block timestamped by its last sample). mean(n) is the average of the
+    last n samples of every input.
+
+    Errors (timeouts, garbled replies) are counted, the pipeline is
+    flushed and re-primed, and the thread backs off instead of spinning.
+    Works on its own serial port as well as on a SerialLoop.
+    """
+    PIPELINE_DEPTH = 2
+    BATCH = 16
+    MIN_BACKOFF = 0.05
+    MAX_BACKOFF = 1.
+
+    def __init__(self, device, size=4096, decimation=1):
+        self.device = device
+        self.inputs = device.inputs
+        self.raw = RingBuffer(size, self.inputs)
+        self.decimation = np.resize(np.asarray(decimation, dtype=int), self.inputs)
+        if self.decimation.max() > size // 2:
+            raise ValueError('Decimation factors must be at most half the buffer size')
+        self.outputs = [RingBuffer(max(size // factor, 1)) for factor in self.decimation]
+        self.cursors = np.zeros(self.inputs, dtype=int)     # Sample of raw where the next block of each input starts
+        self.decimated = 0                                  # raw.count at the last decimation
+        self.pending = collections.deque()                  # Replies in flight, with a loop
+        self.errors = 0
+        self.running = 0
+        self.thread = None
+
+    def start(self):
+        self.running = 1
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = 0
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
-class PowerMeterComm(object):
+    def _request(self):
+        if self.device.loop_channel is not None:
+            self.pending.append(self.device.loop_channel.request('ALLIN?'))
+        else:
+            self.device._serial_write('ALLIN?')
+
+    def _reply(self):
+        if self.device.loop_channel is not None:
+            return self.pending.popleft().result()
+        reply = self.device._serial_read()
+        if not reply:
+            raise IOError('ALLIN? reply timed out')
+        return reply
+
+    def _prime(self):
+        # Throw away any stale replies and fill up the pipeline again
+        if self.device.loop_channel is not None:
+            self.device.loop_channel.reset()
+            self.pending.clear()
+        else:
+            self.device.serial.reset_input_buffer()
+        for i in range(self.PIPELINE_DEPTH):
+            self._request()
+
+    def run(self):
+        backoff = self.MIN_BACKOFF
+        self._prime()
+        while self.running:
+            try:
+                reply = self._reply()
+                now = monotonic()
+                self._request()
+                values = parse_allin(reply)
+                if len(values) < self.inputs:
+                    raise ValueError('ALLIN? reply too short: ' + repr(reply))
+            except (IOError, OSError, ValueError, IndexError, serial.SerialException):
+                self.errors += 1
+                time.sleep(backoff)
+                backoff = min(2 * backoff, self.MAX_BACKOFF)
+                try:
+                    self._prime()
+                except (IOError, OSError, serial.SerialException):
+                    pass
+                continue
+            self.raw.push(now, values[:self.inputs])
+            backoff = self.MIN_BACKOFF
+            # (Not from the cursors: an input with a factor over BATCH lags behind them)
+            if self.raw.count - self.decimated >= self.BATCH:
+                self._decimate()
+
+    def _decimate(self):
+        # Average the new samples of every input in blocks of its decimation factor
+        start = max(self.cursors.min(), self.raw.count - self.raw.size)
+        t, values, stop = self.raw.since(start)
+        start = stop - len(t)
+        self.decimated = stop
+        for i, factor in enumerate(self.decimation):
+            first = max(self.cursors[i], start) - start
+            blocks = (len(t) - first) // factor
+            if not blocks:
+                continue
+            end = first + blocks * factor
+            means = values[first:end, i].reshape(blocks, factor).mean(axis=1)
+            self.outputs[i].extend(t[first + factor - 1:end:factor], means)
+            self.cursors[i] = start + end
+
+    def mean(self, n):
+        ''' Average of the last n samples of every input '''
+        t, values = self.raw.latest(n)
+        return values.mean(axis=0)
+
+
+def analog_rates(device, duration=2.):
+    '''
+    Readings per second of all the inputs of an AnalogComm: one IN? round
+    trip per input, the IN? of all inputs pipelined, one ALLIN? at a time,
+    and an AnalogSampler
+    '''
+    rates = {}
+    channels = range(device.inputs)
+    for name, read in (('IN? each', lambda: [device.get_voltage(channel) for channel in channels]),
+                       ('IN? pipelined', lambda: device.get_voltages(channels)),
+                       ('ALLIN?', device.get_voltage_all)):
+        n = 0
+        start = monotonic()
+        while monotonic() - start < duration:
+            read()
+            n += 1
+        rates[name] = n / (monotonic() - start)
+    sampler = AnalogSampler(device)
+    sampler.start()
+    time.sleep(duration)
+    sampler.stop()
+    times = sampler.raw.latest(sampler.raw.count)[0]
+    rates['sampler'] = (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 else 0.
+    return rates
+
+class PowerMeterComm(LoopDevice):
 # Module for communicating with the power meter 
     '''
     Simple optical power meter.                                                    
@@ -241,11 +461,14 @@ class PowerMeterComm(object):
     '''
 
     baudrate = 115200
-    
-    def __init__(self, port):
-        self.serial = self._open_port(port)
-        self.serial.write(b'*IDN?;')# flush io buffer
-        print (self._serial_read()) #will read unknown command
+    separator = ';'
+    
+    def __init__(self, port, loop=None):
+        if loop is None:
+            self.serial = self._open_port(port)
+        else:
+            self.serial = self._open_channel(loop, port, ';', 1.)
+        print (self._query('*IDN?')) #will read unknown command
         self.set_range(4)
         self.range = self.get_range
         self.data = self._read_cal_file()
@@ -258,7 +481,7 @@ class PowerMeterComm(object):
         return ser
         
     def close(self):
-        self.serial.close()
+        self._close()
 
         
     
@@ -272,30 +495,28 @@ class PowerMeterComm(object):
         return msg_string
     
     def reset(self):
-        self._serial_write('*RST')
-        return self._serial_read()
+        return self._query('*RST')
         
     def get_voltage(self):
-        self._serial_write('VOLT?')    
-        voltage = self._serial_read()
+        voltage = self._query('VOLT?')
         #print voltage
         return voltage
         
     def get_range(self):
-        self._serial_write('RANGE?')
-        pm_range = self._serial_read()
+        pm_range = self._query('RANGE?')
         #print pm_range
+        if pm_range:
+            self.pm_range = int(pm_range) - 1   # Cached for get_power
         return pm_range
     
     
     def set_range(self,value):
-        self._serial_write('RANGE'+ str(value))
+        self._send('RANGE'+ str(value))
         self.pm_range = value -1
         return self.pm_range
     
     def serial_number(self):
-        self.serial.write(b'*IDN?')
-        return self.serial.read()
+        return self._query('*IDN?')
         
         """this section of the code deals with converting between the voltage value and the
     optical power at the wavelength of interest"""
@@ -310,31 +531,173 @@ class PowerMeterComm(object):
         f = open(self.file_name,'r')
         x = json.load(f)
         f.close()
+        # Also as arrays sorted by wavelength, for interpolation
+        order = np.argsort(x[0])
+        self.cal_wavelengths = np.asarray(x[0], dtype=float)[order]
+        self.cal_responsivities = np.asarray(x[1], dtype=float)[order]
+        self.factors = {}   # (wavelength, range_number): W per V
         return x
         
+    def responsivity(self,wavelength):
+        # A/W at any wavelength (nm) within the calibration, linearly interpolated
+        if not self.cal_wavelengths[0] <= wavelength <= self.cal_wavelengths[-1]:
+            raise ValueError('Wavelength %s nm outside the calibration (%g to %g nm)'
+                             % (wavelength, self.cal_wavelengths[0], self.cal_wavelengths[-1]))
+        return float(np.interp(wavelength, self.cal_wavelengths, self.cal_responsivities))
+
+    def power_factor(self,wavelength,range_number):
+        # Optical power (W) per volt across the sense resistor, cached
+        key = (wavelength, range_number)
+        factor = self.factors.get(key)
+        if factor is None:
+            factor = self.factors[key] = 1. / (self.resistors[range_number - 1] * self.responsivity(wavelength))
+        return factor
 
     def volt2amp(self,voltage,range_number):
-        self.amp = voltage/self.resistors[range_number]
+        self.amp = np.asarray(voltage, dtype=float)/self.resistors[range_number]
         return self.amp
                             
     
     def amp2power(self,voltage,wavelength,range_number):
         amp = self.volt2amp(voltage,range_number-1)
-        xdata = self.data[0]
-        ydata = self.data[1]
-        i = xdata.index(int(wavelength))
-        responsivity = ydata[i]
-        power = amp/float(responsivity)
-        
-        return power
-    
-    def get_power(self,wavelength):
-        
-        self.power = self.amp2power(float(self.get_voltage()),wavelength,int(self.get_range()))
+        return amp/self.responsivity(wavelength)
+
+    def volts2power(self,voltages,wavelength,range_number=None):
+        # Any array of voltages to optical power (W) at once, on the current range by default
+        if range_number is None:
+            range_number = self.pm_range + 1
+        return np.asarray(voltages, dtype=float) * self.power_factor(wavelength, range_number)
+    
+    def get_power(self,wavelength,check_range=False):
+        # The range is the one last set or read, unless check_range (then VOLT? and RANGE? in one round trip)
+        if check_range:
+            voltage, pm_range = [reply.result() for reply in self._query_pipelined(['VOLT?', 'RANGE?'])]
+            self.pm_range = int(pm_range) - 1
+        else:
+            voltage = self.get_voltage()
+        self.power = float(voltage) * self.power_factor(wavelength, self.pm_range + 1)
         return self.power
 
 
-class CounterComm(object):
+# Value of every byte as a hex digit, -1 for anything else (line endings, spaces)
+HEX_DIGITS = -np.ones(256, dtype=np.int64)
+for digits, first in ((b'0123456789', 0), (b'abcdef', 10), (b'ABCDEF', 10)):
+    HEX_DIGITS[np.frombuffer(digits, dtype=np.uint8)] = np.arange(first, first + len(digits))
+
+
+def decode_hex_lines(data):
+    '''
+    The values of all the complete lines of hex digits in data (bytes) as
+    an int64 array, decoded in bulk, and the partial line left at the end.
+    Empty lines are skipped.
+    '''
+    end = data.rfind(b'\n') + 1
+    nibbles = HEX_DIGITS[np.frombuffer(data[:end], dtype=np.uint8)]
+    digit = nibbles >= 0
+    if not digit.any():
+        return np.zeros(0, dtype=np.int64), data[end:]
+    line = np.cumsum(~digit)[digit]         # Line of every digit (numbered by the separators before it)
+    starts = np.flatnonzero(np.concatenate(([True], line[1:] != line[:-1])))
+    lengths = np.diff(np.concatenate((starts, [len(line)])))
+    # Power of 16 of every digit: digits left in its line after it
+    shift = np.repeat(starts + lengths, lengths) - 1 - np.arange(len(line))
+    values = np.add.reduceat(nibbles[digit] << (4 * shift), starts)
+    return values, data[end:]
+
+
+class PowerMeterFlow(object):
+    """
+    FLOW mode of a PowerMeterComm: the meter samples every PERIOD s and
+    streams every sample as a line of hex (raw units). A thread reads the
+    stream in chunks, decodes every chunk in one go (decode_hex_lines) and
+    appends it to a mirrored ring buffer of raw values. USB delivers the
+    samples in bursts, so their arrival says little about when they were
+    taken: sample k is timestamped start_time + (k + 1) * PERIOD, counted
+    from when FLOW was sent (on the meter's clock, so the timestamps never
+    go backwards). window(n) hands out the last n samples without copying;
+    to_volts() and to_power() convert arrays.
+
+    The meter is not available for anything else until stop() sends STOP.
+    If it is on a SerialLoop, its channel is taken off the loop meanwhile.
+    volts_per_raw, if not given, comes from VOLT?;RAW? before starting
+    (RAW? replying in decimal; it stays unknown if the meter reads 0).
+    """
+    PERIOD = 1e-3
+    READ_TIMEOUT = 0.05
+
+    def __init__(self, meter, size=65536, volts_per_raw=None):
+        self.meter = meter
+        self.volts_per_raw = volts_per_raw
+        self.buffer = RingBuffer(size, dtype=np.int64, mirror=True)
+        self.rest = b''
+        self.chunks = 0
+        self.samples = 0            # Samples since FLOW
+        self.start_time = None      # When FLOW was sent
+        self.running = 0
+        self.thread = None
+        self.timeout = None
+
+    def start(self):
+        meter = self.meter
+        if self.volts_per_raw is None:
+            volt, raw = [reply.result() for reply in meter._query_pipelined(['VOLT?', 'RAW?'])]
+            if float(raw):
+                self.volts_per_raw = float(volt) / float(raw)
+        if meter.loop_channel is not None:
+            meter.loop_channel.loop.remove(meter.loop_channel)
+        self.timeout = meter.serial.timeout
+        meter.serial.timeout = self.READ_TIMEOUT
+        meter.serial.reset_input_buffer()
+        self.rest = b''
+        meter._serial_write('FLOW')
+        self.start_time = monotonic()
+        self.samples = 0
+        self.running = 1
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        port = self.meter.serial
+        while self.running:
+            data = port.read(max(port.in_waiting, 1))
+            if not data:
+                continue
+            values, self.rest = decode_hex_lines(self.rest + data)
+            if len(values):
+                index = self.samples + 1 + np.arange(len(values))
+                self.buffer.extend(self.start_time + self.PERIOD * index, values)
+                self.samples += len(values)
+                self.chunks += 1
+
+    def stop(self):
+        meter = self.meter
+        self.running = 0
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        meter._serial_write('STOP')
+        time.sleep(self.READ_TIMEOUT)           # Let the last samples arrive, then drop them
+        meter.serial.reset_input_buffer()
+        meter.serial.timeout = self.timeout
+        if meter.loop_channel is not None:
+            meter.loop_channel.reset()
+            meter.loop_channel.loop.attach(meter.loop_channel)
+
+    def window(self, n):
+        ''' (timestamps, raw values) of the last n samples, as views (see RingBuffer.window) '''
+        return self.buffer.window(n)
+
+    def to_volts(self, raw):
+        if self.volts_per_raw is None:
+            raise ValueError('Volts per raw unit unknown')
+        return np.asarray(raw) * self.volts_per_raw
+
+    def to_power(self, raw, wavelength):
+        return self.meter.volts2power(self.to_volts(raw), wavelength)
+
+
+class CounterComm(LoopDevice):
 # Module for communicating with the mini usb counter board
     """
     Simple USB counter.
@@ -361,10 +724,12 @@ class CounterComm(object):
     
     baudrate = 115200
     
-    def __init__(self, port):
-        self.serial = self._open_port(port)
-        self._serial_write('*IDN?')# flush io buffer
-        print (self._serial_read()) #will read unknown command
+    def __init__(self, port, loop=None):
+        if loop is None:
+            self.serial = self._open_port(port)
+        else:
+            self.serial = self._open_channel(loop, port, '\n', 1.)
+        print (self._query('*IDN?')) #will read unknown command
 
         
     def _open_port(self, port):
@@ -381,44 +746,44 @@ class CounterComm(object):
         return msg_string
     
     def reset(self):
-        self._serial_write('*RST')
-        return self._serial_read()
+        return self._query('*RST')
         
     def get_counts(self):
-        self._serial_write('COUNTS?')
-        counts = self._serial_read()
+        counts = self._query('COUNTS?')
         return counts
         
     def get_gate_time(self):
-        self._serial_write('TIME?')
-        out = self._serial_read()
+        out = self._query('TIME?')
         return out 
         
     def get_digital(self):
-        self._serial_write('LEVEL?')
-        level = self._serial_read()
+        level = self._query('LEVEL?')
         return level
+
+    def get_settings(self):
+        # Gate time and input level in one round trip
+        replies = self._query_pipelined(['TIME?', 'LEVEL?'])
+        return [reply.result() for reply in replies]
     
     
     def set_gate_time(self,value):
-        self._serial_write('TIME'+ str(int(value)))
+        self._send('TIME'+ str(int(value)))
         return 
     
 
     def set_TTL(self):
-        self._serial_write('TTL')
+        self._send('TTL')
         return
          
     def set_NIM(self):
-        self._serial_write('NIM')
+        self._send('NIM')
         return
          
     def close(self): 
-        self.serial.close()
+        self._close()
         
     def serial_number(self):
-        self._serial_write('*IDN?')
-        return self._serial_read()
+        return self._query('*IDN?')
 
 class DDSComm(object):
     """
@@ -463,9 +828,21 @@ class DDSComm(object):
     """
     
 
-    def __init__(self,port,channel):
+    #DDSPROG = "/home/qitlab/programs/usbdds/apps/dds_encode"
+    DDSPROG = "/home/qitlab/programs/usbdds/apps/dds_encode"
+    #DDSRESET = "/home/qitlab/programs/usbdds/apps/reset_dds"
+    DDSRESET = "/home/qitlab/programs/usbdds/apps/reset_dds"
+
+    def __init__(self,port,channel,persistent=False):
+        # persistent: keep one dds_encode running and feed it the commands
+        # line by line (if the installed dds_encode acts on every line as
+        # it comes, not only at the end of its input)
         self.DDSDEV = port
         self.channel = channel
+        self.batch = None       # Commands of the transaction being built
+        self.pipe = None
+        if persistent:
+            self.pipe = sp.Popen([self.DDSPROG, '-T', '-d', self.DDSDEV], stdin=sp.PIPE)
 
     
     ##default dds_encode function
@@ -493,32 +870,95 @@ class DDSComm(object):
     def start(self):
         #default assume no modulation
         self.reset()
-        self.call('levels 2')
-        self.call('mode singletone')
+        with self.transaction():
+            self.call('levels 2')
+            self.call('mode singletone')
     
     def reset_freq(self,freq):
         #compact function assuming freq in MHz, amp to max (1023)
-        self.off()
-        self.set_freq(freq)
-        self.on()
+        with self.transaction():
+            self.off()
+            self.set_freq(freq)
+            self.on()
         
     def on(self):
         self.amplitude(100,'ampunits')
     
     def off(self):
         self.amplitude(0,'ampunits')    
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Collect the commands of a with block and send them in one go when
+        it ends (nothing is sent if it raises). Nested blocks join the
+        outer transaction.
+        '''
+        if self.batch is not None:
+            yield self
+            return
+        self.batch = []
+        try:
+            yield self
+            commands = self.batch
+        finally:
+            self.batch = None
+        if commands:
+            self.send(commands)
     
     def call(self,command):
         #interface function to dds_encode
-        #DDSPROG = "/home/qitlab/programs/usbdds/apps/dds_encode"
-        DDSPROG = "/home/qitlab/programs/usbdds/apps/dds_encode"
-        sp.call(['echo '+command+' \;. |'+DDSPROG+' -T -d '+self.DDSDEV],shell=True)
+        if self.batch is not None:
+            self.batch.append(command)
+        else:
+            self.send([command])
+
+    def send(self,commands):
+        #all the commands in one dds_encode invocation (no shell), or one write to the persistent one
+        if self.pipe is not None:
+            self.pipe.stdin.write(('\n'.join(commands) + '\n').encode('UTF-8'))
+            self.pipe.stdin.flush()
+            return
+        script = ';'.join(commands) + ' ;.\n'
+        sp.Popen([self.DDSPROG, '-T', '-d', self.DDSDEV], stdin=sp.PIPE).communicate(script.encode('UTF-8'))
     
     def reset(self):
         #dds full reset / switch off
-        #DDSRESET = "/home/qitlab/programs/usbdds/apps/reset_dds"
-        DDSRESET = "/home/qitlab/programs/usbdds/apps/reset_dds"
-        sp.call(DDSRESET)
+        sp.call(self.DDSRESET)
+
+    def close(self):
+        if self.pipe is not None:
+            self.pipe.stdin.write(b'.\n')
+            self.pipe.stdin.close()
+            self.pipe.wait()
+            self.pipe = None
+
+class USBDacProg(object):
+# Module for the usb pattern generator DAC board, via usbdacset
+    """
+    Spawns the usbdacset test application once per channel and update.
+    set_voltages takes a frame, a list of (channel, value) pairs, but
+    usbdacset only takes one channel, so the channels of a frame still go
+    out one after the other. There is no playback_step/play() (ramps played
+    by the board itself): the controller steps the ramps, one frame per tick.
+    """
+
+    def __init__(self, port, prog):
+        self.port = port
+        self.prog = prog
+
+    def set_voltage(self, channel, value):
+        sp.call([self.prog + " -d " + self.port + " " + str(channel) + " " + '%.3f'%round(value,3)], shell=True)
+
+    def set_voltages(self, frame):
+        # usbdacset only takes one channel, so the frame is not atomic here
+        for channel, value in frame:
+            self.set_voltage(channel, value)
+
+    def close(self):
+        pass
+
+
 if __name__=='__main__':
     Power_meter_address = '/dev/serial/by-id/usb-Centre_for_Quantum_Technologies_Optical_Power_Meter_OPM-QO04-if00'
     #ser=serial.Serial(Power_meter_address)
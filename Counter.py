@@ -23,17 +23,75 @@ HELP      Print this help text.
 """
 
 import serial
+import threading
+import time
+import collections
+import numpy as np
+from clock import monotonic
+from ringbuffer import RingBuffer
+from serial_loop import LoopDevice
 
 
-class Countercomm(object):
+def parse_counts(reply):
+    # All the channels of a COUNTS? reply as an int array, parsed in one go without splitting
+    return np.fromstring(reply, dtype=np.int32, sep=' ')
+
+
+def weighted(weights):
+    # Lock signal: weighted sum of the channels read
+    weights = np.asarray(weights, dtype=float)
+    return lambda counts: float(np.dot(weights, counts))
+
+
+def ratio(numerator, denominator):
+    # Lock signal: ratio of two of the channels read (0 when the denominator has no counts)
+    def signal(counts):
+        if counts[denominator] == 0:
+            return 0.
+        return counts[numerator] / float(counts[denominator])
+    return signal
+
+
+class AdaptiveGate(object):
+    """
+    Picks the shortest gate time whose counts have a relative shot noise
+    (1/sqrt(counts)) of at most target_noise, at the count rate of the last
+    gate, within [min_gate, max_gate] s and in whole ms. The gate only
+    changes when the new one differs by more than hysteresis (relative), so
+    the counter does not get a TIME command after every gate.
+    """
+
+    def __init__(self, target_noise=0.05, min_gate=0.005, max_gate=0.1, hysteresis=0.2):
+        self.target_noise = target_noise
+        self.min_gate = min_gate
+        self.max_gate = max_gate
+        self.hysteresis = hysteresis
+
+    def next_gate(self, counts, gate, current=None):
+        # Gate time to use after a gate of gate s gave counts, if the counter is currently set to current
+        current = gate if current is None else current
+        if counts > 0:
+            wanted = gate / (self.target_noise**2 * counts)
+        else:
+            wanted = self.max_gate
+        wanted = min(max(round(wanted * 1000) / 1000., self.min_gate, 0.001), self.max_gate)
+        if abs(wanted - current) > self.hysteresis * current:
+            return wanted
+        return current
+
+
+class Countercomm(LoopDevice):
 # Module for communicating with the mini usb IO board
     baudrate = 115200
     
-    def __init__(self, port):
-        self.serial = self._open_port(port)
-        print self._serial_read() #will read unknown command
-        self._serial_write('a')# flush io buffer
-        print self._serial_read() #will read unknown command
+    def __init__(self, port, loop=None):
+        self.gate_time = None   # s, known once set with set_gate_time
+        if loop is None:
+            self.serial = self._open_port(port)
+            print self._serial_read() #will read unknown command
+        else:
+            self.serial = self._open_channel(loop, port, '\n', 1.)
+        print self._query('a') #will read unknown command
 
         
     def _open_port(self, port):
@@ -52,41 +110,235 @@ class Countercomm(object):
         return msg_string
     
     def reset(self):
-        self._serial_write('*RST')
-        return self._serial_read()
+        return self._query('*RST')
         
     def get_counts(self,channel):
-        self._serial_write('COUNTS?')
-        counts = (self._serial_read()).split()[channel]
+        counts = (self._query('COUNTS?')).split()[channel]
         
         return counts
+
+    def get_all_counts(self):
+        # All the channels of one gate: (monotonic time of the reply, gate time in s, int array of counts)
+        reply = self._query('COUNTS?')
+        return monotonic(), self.gate_time, parse_counts(reply)
         
     def get_gate_time(self):
-        self._serial_write('TIME?')
-        out = self._serial_read()
+        out = self._query('TIME?')
         return out 
 
     def get_digital(self):
-        self._serial_write('LEVEL?')
-        level = self._serial_read()
+        level = self._query('LEVEL?')
         return level
     
     
     def set_gate_time(self,value):
-        self._serial_write('TIME'+ str(int(value)))
+        self._send('TIME'+ str(int(value)))
+        self.gate_time = int(value) / 1000.
         return 
     
 
     def set_TTL(self):
-         self._serial_write('TTL')
+         self._send('TTL')
          return
          
     def set_NIM(self):
-         self._serial_write('NIM')
+         self._send('NIM')
          return
          
          
     
     def serial_number(self):
-        self._serial_write('*IDN?')
-        return self._serial_read()
\ No newline at end of file
+        return self._query('*IDN?')
+
+    def close(self):
+        self._close()
+
+
+class CountAcquisition(object):
+    """
+    Back-to-back acquisition from a Countercomm.
+
+    Every reply holds all the channels of the gate. With a single channel
+    (an int), its counts go into buffer as before. With a list of channels,
+    their counts go into raw (a ring buffer of int rows, one column per
+    channel), and buffer gets the lock signal: signal(counts of the listed
+    channels), e.g. weighted([1, 0.5]) or ratio(0, 1), or the first listed
+    channel if no signal is given. Either way, one gate serves all channels.
+
+    With an adaptive_gate (AdaptiveGate), the gate time follows the count
+    level (of the dimmest listed channel): a TIME command goes out just
+    before the next COUNTS?, and the gate time of every request in flight
+    is remembered. With normalize_to (s), the counts are scaled to counts
+    per normalize_to seconds before they go into buffer (or into the
+    signal, so a weighted sum scales and a ratio does not), so that the
+    lock and its threshold do not care about the gate time. raw keeps the
+    counts as they came.
+
+    The counter reads commands from its serial buffer while it is busy, so
+    we keep PIPELINE_DEPTH COUNTS? requests in flight: as soon as one reply
+    comes back, the next gate is already running and we queue another one.
+    Every reply is pushed into a preallocated ring buffer with a monotonic
+    timestamp taken when the reply arrived (i.e. at the end of the gate).
+
+    Errors (timeouts, garbled replies) are counted, the pipeline is flushed
+    and re-primed, and the thread backs off instead of spinning.
+
+    With stats (see instrumentation.py), the time spent waiting for every
+    reply goes into the 'counter_readline' histogram and the errors are
+    counted as 'counter_errors'.
+
+    If the counter was opened with a SerialLoop (see serial_loop.py), there
+    is no thread: the replies are handled on the loop thread as they come
+    in, the back off is a timer of the loop, and 'counter_readline' is the
+    time from request to reply (gate time included).
+    """
+    PIPELINE_DEPTH = 2
+    MIN_BACKOFF = 0.05
+    MAX_BACKOFF = 1.
+
+    def __init__(self, counter, channel=0, size=4096, stats=None, signal=None, adaptive_gate=None, normalize_to=None):
+        self.counter = counter
+        self.channel = channel
+        self.adaptive_gate = adaptive_gate
+        self.normalize_to = normalize_to
+        self.gate_time = counter.gate_time  # s, of the next request
+        self.in_flight = collections.deque()    # Gate times of the requests in flight, oldest first
+        self.buffer = RingBuffer(size)
+        self.raw = None
+        if isinstance(channel, (list, tuple)):
+            self.channels = np.array(channel)
+            self.raw = RingBuffer(size, len(channel), np.int32)
+            self.signal = signal if signal is not None else (lambda counts: float(counts[0]))
+        self.errors = 0
+        self.backoff = self.MIN_BACKOFF
+        self.generation = 0     # Bumped whenever the pipeline is flushed, to ignore the replies of before
+        self.stats = stats
+        self.running = 0
+        self.thread = None
+
+    def start(self):
+        self.running = 1
+        if self.counter.loop_channel is not None:
+            self._loop_prime()
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = 0
+        self.generation += 1
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _prime(self):
+        # Throw away any stale replies and fill up the pipeline again
+        self.counter.serial.reset_input_buffer()
+        self.in_flight.clear()
+        for i in range(self.PIPELINE_DEPTH):
+            self.counter._serial_write('COUNTS?')
+            self.in_flight.append(self.gate_time)
+
+    def _parse(self, reply):
+        # (counts of the single channel or None, count level for the adaptive gate, counts of the listed channels or None)
+        if not reply:
+            raise IOError('Counter reply timed out')
+        if self.raw is None:
+            value = float(reply.split()[self.channel])
+            return value, value, None
+        counts = parse_counts(reply)
+        if len(counts) <= self.channels.max():
+            raise ValueError('Counter reply too short: ' + repr(reply))
+        counts = counts[self.channels]
+        return None, counts.min(), counts
+
+    def _adapt(self, level, gate_time):
+        # New gate time from the counts of a gate of gate_time, sent before the next COUNTS?
+        if self.adaptive_gate is not None and gate_time:
+            new_gate_time = self.adaptive_gate.next_gate(level, gate_time, self.gate_time)
+            if new_gate_time != self.gate_time:
+                self.counter.set_gate_time(round(new_gate_time * 1000))
+                self.gate_time = new_gate_time
+
+    def _store(self, now, value, counts, gate_time):
+        # Counts are normalized before the lock signal, so that e.g. a ratio is left alone
+        scale = self.normalize_to / gate_time if self.normalize_to and gate_time else 1.
+        if self.raw is not None:
+            self.raw.push(now, counts)
+            value = self.signal(counts * scale)
+        else:
+            value *= scale
+        self.buffer.push(now, value)
+
+    def _error(self):
+        self.errors += 1
+        if self.stats is not None:
+            self.stats.count('counter_errors')
+        backoff = self.backoff
+        self.backoff = min(2 * backoff, self.MAX_BACKOFF)
+        return backoff
+
+    def run(self):
+        self._prime()
+        while self.running:
+            try:
+                start = monotonic()
+                reply = self.counter._serial_read()
+                now = monotonic()
+                if self.stats is not None:
+                    self.stats.record('counter_readline', now - start)
+                gate_time = self.in_flight.popleft() if self.in_flight else self.gate_time
+                value, level, counts = self._parse(reply)
+                # Keep the pipeline full (with a new gate time if needed) before anything else
+                self._adapt(level, gate_time)
+                self.counter._serial_write('COUNTS?')
+                self.in_flight.append(self.gate_time)
+            except (IOError, OSError, ValueError, IndexError, serial.SerialException):
+                time.sleep(self._error())
+                try:
+                    self._prime()
+                except (IOError, OSError, serial.SerialException):
+                    pass
+                continue
+            self._store(now, value, counts, gate_time)
+            self.backoff = self.MIN_BACKOFF
+
+    # With a SerialLoop: no thread, every reply is handled by a callback on the loop thread
+
+    def _loop_prime(self):
+        # Fail (and ignore) the replies in flight and fill up the pipeline again
+        self.generation += 1
+        self.counter.loop_channel.reset()
+        for i in range(self.PIPELINE_DEPTH):
+            self._loop_request()
+
+    def _loop_request(self):
+        generation, gate_time, sent = self.generation, self.gate_time, monotonic()
+        reply = self.counter._query_async('COUNTS?')
+        reply.add_done_callback(lambda reply: self._loop_reply(reply, generation, gate_time, sent))
+
+    def _loop_reply(self, reply, generation, gate_time, sent):
+        if generation != self.generation or not self.running:
+            return      # Flushed since it was sent
+        now = monotonic()
+        try:
+            if self.stats is not None:
+                self.stats.record('counter_readline', now - sent)
+            value, level, counts = self._parse(reply.result())
+            self._adapt(level, gate_time)
+            self._loop_request()
+        except (IOError, OSError, ValueError, IndexError, serial.SerialException):
+            self.generation += 1    # The other reply in flight is out of step too
+            self.counter.loop_channel.loop.call_later(self._error(), self._loop_restart)
+            return
+        self._store(now, value, counts, gate_time)
+        self.backoff = self.MIN_BACKOFF
+
+    def _loop_restart(self):
+        if not self.running:
+            return
+        try:
+            self._loop_prime()
+        except (IOError, OSError, serial.SerialException):
+            self.counter.loop_channel.loop.call_later(self._error(), self._loop_restart)
@@ -0,0 +1,285 @@
+'''
+Simulated cavity, counter and DAC for exercising the retreat controller
+without the cavity, the USB counter or the DAC
+Aug 2016
+
+The plant maps the six DAC voltages to a count rate: a Lorentzian around
+drifting resonance voltages on top of a background. The voltages act on
+the cavity with a dead time (latency), and every counter gate gives a
+Poisson distributed number of counts. Everything runs on a VirtualClock,
+so the whole controller (filter, lock, voltage ramps) runs much faster
+than real time.
+
+Usage:
+    sim = Simulation(seed=1)
+    sim.controller.set_value[0] = 600           # Threshold
+    sim.run(2)                                  # 2 s of virtual time
+    sim.controller.setLockStatus(1)
+    sim.plant.kick([0, 0, 0, 0, 0.02, -0.03])   # Knock the cavity off resonance
+    ...
+
+Run this file for a demo of repeated lock acquisitions.
+'''
+
+import itertools
+import time
+import numpy as np
+
+from clock import VirtualClock
+from ringbuffer import RingBuffer
+import retreat_controller as rc
+
+
+class CavityPlant(object):
+    '''
+    Count rate (counts/s) = background + peak / (1 + sum(((V - center)/width)^2))
+    over the six channels. Channels with an infinite width have no effect.
+    The centers drift linearly (drift, V/s) and as a random walk (diffusion,
+    V/sqrt(s)), both fixed at construction. The cavity sees the DAC voltages
+    of `latency` seconds ago.
+    '''
+
+    def __init__(self, peak=50000., background=500., center=(0, 0, 0, 0, 0, 0),
+                 width=(np.inf, np.inf, np.inf, np.inf, 0.02, 0.02),
+                 drift=(0, 0, 0, 0, 0, 0), diffusion=(0, 0, 0, 0, 0, 0),
+                 latency=0.01, seed=None):
+        self.peak = peak
+        self.background = background
+        self.center = np.array(center, dtype=float)
+        self.width = np.array(width, dtype=float)
+        self.drift = np.array(drift, dtype=float)
+        self.diffusion = np.array(diffusion, dtype=float)
+        self.drifting = bool(self.drift.any() or self.diffusion.any())
+        self.latency = latency
+        self.random = np.random.RandomState(seed)
+        self.time = 0.
+        # History of the DAC voltages, oldest first
+        self.history_time = [-np.inf]
+        self.history_voltages = [np.zeros(6)]
+
+    def set_voltages(self, t, voltages):
+        self.history_time.append(t)
+        self.history_voltages.append(np.array(voltages, dtype=float))
+
+    def forget_after(self, t):
+        ''' Drop the voltages scheduled after t (a playback that got interrupted) '''
+        index = np.searchsorted(self.history_time, t, side='right')
+        del self.history_time[index:], self.history_voltages[index:]
+
+    def voltages(self, t):
+        ''' DAC voltages acting on the cavity at the times t (increasing array), one row per time '''
+        index = np.searchsorted(self.history_time, np.asarray(t) - self.latency, side='right') - 1
+        first, last = int(index[0]), int(index[-1])
+        if first == last:
+            # Same voltages all along (most of the time), a single row does
+            voltages = self.history_voltages[first]
+        else:
+            voltages = np.array(self.history_voltages[first:last + 1])[index - first]
+        # Forget what can't be needed any more (times only go forward)
+        del self.history_time[:first], self.history_voltages[:first]
+        return voltages
+
+    def kick(self, offsets):
+        ''' Move the resonance by offsets (V), as a sudden disturbance '''
+        self.center = self.center + np.array(offsets, dtype=float)
+
+    def centers(self, t):
+        ''' Drift the resonance up to the times t (array), returns the center at each of them '''
+        if not self.drifting:
+            self.time = t[-1]
+            return self.center
+        dt = np.diff(np.concatenate(([self.time], t)))[:, None]
+        steps = self.drift*dt + self.diffusion*np.sqrt(dt)*self.random.standard_normal((len(t), 6))
+        centers = self.center + np.cumsum(steps, axis=0)
+        self.center = centers[-1]
+        self.time = t[-1]
+        return centers
+
+    def rate(self, voltages, center=None):
+        center = self.center if center is None else center
+        detuning = (voltages - center)/self.width
+        return self.background + self.peak / (1 + np.einsum('...i,...i', detuning, detuning))
+
+    def counts(self, start, stop):
+        '''
+        Poisson counts of the gates from start to stop (arrays), at the
+        voltages and resonance of the middle of each gate
+        '''
+        middle = (start + stop)/2.
+        rate = self.rate(self.voltages(middle), self.centers(middle))
+        return self.random.poisson(rate * (stop - start))
+
+
+class SimulatedDAC(object):
+    '''
+    Same interface as CQTdevices.USBDacProg, writes to the plant. With a
+    playback_step (s), it also plays whole ramps by itself, like a pattern
+    generator: play() schedules the voltages of the ramps in the plant, and
+    a later write or ramp on a channel replaces what is left of its ramp.
+    '''
+
+    def __init__(self, plant, clock, playback_step=None):
+        self.plant = plant
+        self.clock = clock
+        self.values = np.zeros(8)
+        self.writes = 0         # Number of set_voltage(s) and play calls, i.e. transactions with the board
+        if playback_step:
+            self.playback_step = playback_step
+        self.ramps = {}         # channel: (start time, points, voltage before) of the ramps being played
+
+    def set_voltage(self, channel, value):
+        self.set_voltages([(channel, value)])
+
+    def set_voltages(self, frame):
+        for channel, value in frame:
+            self.values[channel] = value
+            self.ramps.pop(channel, None)
+        self.writes += 1
+        self.schedule()
+
+    def output(self, channel, now):
+        ''' Voltage of the channel at now '''
+        if channel not in self.ramps:
+            return self.values[channel]
+        start, points, before = self.ramps[channel]
+        played = int((now - start) / self.playback_step + 1e-6)
+        return points[min(played, len(points)) - 1] if played > 0 else before
+
+    def play(self, ramps, step):
+        now = self.clock()
+        for channel, points in ramps:
+            self.ramps[channel] = (now, np.asarray(points, dtype=float), self.output(channel, now))
+            self.values[channel] = points[-1]   # Where the channel stays once the ramp is over
+        self.writes += 1
+        self.schedule()
+
+    def schedule(self):
+        # Voltages from now on: the values, with the ramps still playing on top
+        now = self.clock()
+        self.plant.forget_after(now)
+        voltages = np.array([self.output(channel, now) for channel in range(6)])
+        self.plant.set_voltages(now, voltages)
+        for channel, (start, points, before) in list(self.ramps.items()):
+            if start + len(points) * self.playback_step <= now + 1e-9:
+                del self.ramps[channel]
+        if not self.ramps:
+            return
+        end = max([start + len(points) * self.playback_step for start, points, before in self.ramps.values()])
+        times = np.arange(now + self.playback_step, end + self.playback_step/2, self.playback_step)
+        track = np.tile(voltages, (len(times), 1))
+        for channel, (start, points, before) in self.ramps.items():
+            index = ((times - start) / self.playback_step + 1e-6).astype(int) - 1
+            track[:, channel] = points[np.clip(index, 0, len(points) - 1)]
+        self.plant.history_time.extend(times)
+        self.plant.history_voltages.extend(track)
+
+    def close(self):
+        pass
+
+
+class SimulatedAcquisition(object):
+    '''
+    Same interface as Counter.CountAcquisition: back-to-back gates of
+    gate_time seconds, pushed into a ring buffer as the virtual clock
+    advances. With an adaptive_gate (Counter.AdaptiveGate), every gate
+    time follows the counts of the previous gate (one gate at a time, so
+    slower). With normalize_to (s), the counts are per normalize_to seconds.
+    '''
+
+    def __init__(self, plant, clock, gate_time=0.03, size=4096, adaptive_gate=None, normalize_to=None):
+        self.plant = plant
+        self.clock = clock
+        self.gate_time = gate_time
+        self.adaptive_gate = adaptive_gate
+        self.normalize_to = normalize_to
+        self.buffer = RingBuffer(size)
+        self.errors = 0
+        self.gate_start = clock()
+        clock.listeners.append(self.advance)
+
+    def advance(self, now):
+        if self.adaptive_gate is not None:
+            while self.gate_start + self.gate_time <= now:
+                start = np.array([self.gate_start])
+                stop = start + self.gate_time
+                counts = self.plant.counts(start, stop)[0]
+                self.buffer.push(stop[0], counts * self.normalize_to / self.gate_time if self.normalize_to else counts)
+                self.gate_start = stop[0]
+                self.gate_time = self.adaptive_gate.next_gate(counts, self.gate_time)
+            return
+        n = int((now - self.gate_start) // self.gate_time)
+        if n <= 0:
+            return
+        start = self.gate_start + self.gate_time*np.arange(n)
+        stop = start + self.gate_time
+        counts = self.plant.counts(start, stop)
+        if self.normalize_to:
+            counts = counts * self.normalize_to / self.gate_time
+        for t, value in zip(stop, counts):
+            self.buffer.push(t, value)
+        self.gate_start = stop[-1]
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Simulation(object):
+    '''
+    A RetreatController wired to a simulated plant on a virtual clock. The
+    zmq sockets are bound to inproc addresses, so several simulations (and
+    a real controller) can run side by side.
+    '''
+    instances = itertools.count()
+
+    def __init__(self, plant=None, gate_time=0.03, speed=None, seed=None, playback_step=None, adaptive_gate=None):
+        n = next(self.instances)
+        self.clock = VirtualClock(speed=speed)
+        self.plant = CavityPlant(seed=seed) if plant is None else plant
+        self.dac = SimulatedDAC(self.plant, self.clock, playback_step)
+        self.acquisition = SimulatedAcquisition(self.plant, self.clock, gate_time, adaptive_gate=adaptive_gate,
+                                                normalize_to=gate_time if adaptive_gate is not None else None)
+        self.controller = rc.RetreatController(self.acquisition, self.dac, self.clock, self.clock.sleep,
+                                               'inproc://sim-commands-%d' % n, 'inproc://sim-telemetry-%d' % n)
+        self.controller.running = 1
+
+    def run(self, duration, until=None):
+        ''' Run the control loop for duration s of virtual time, or until until() is True '''
+        stop_time = self.clock() + duration
+        if until is None:
+            until = lambda: False
+        self.controller.scheduler.run(lambda: self.clock() >= stop_time or until())
+
+    def close(self):
+        self.controller.server.socket.close(linger=0)
+        self.controller.server.replies.close(linger=0)
+        self.controller.telemetry.close(linger=0)
+
+
+if __name__ == '__main__':
+    # Demo: lock, knock the cavity off resonance, ask for the lock again, many times
+    sim = Simulation(seed=1)
+    controller = sim.controller
+    controller.set_value[0] = 30000 * 0.03      # Threshold in counts per gate
+    sim.run(2)
+    controller.setLockStatus(1)
+    sim.run(1)
+
+    random = np.random.RandomState(2)
+    times = []
+    wall_start = time.time()
+    virtual_start = sim.clock()
+    for attempt in range(20):
+        sim.plant.kick([0, 0, 0, 0] + list(random.choice([-1, 1], 2) * random.uniform(0.02, 0.05, 2)))
+        sim.run(2)
+        controller.handleMessage("Please Lock")
+        sim.run(1)
+        sim.run(60, until=lambda: controller.lock_process != 1)
+        controller.handleMessage("Check Lock")
+        times.append(controller.time_to_lock if controller.lock_process == 2 else None)
+    wall = time.time() - wall_start
+    print "Time to lock (s):", ', '.join(['%.1f' % t if t is not None else 'failed' for t in times])
+    print "%.0f s of virtual time in %.1f s (%.0fx real time)" % (sim.clock() - virtual_start, wall, (sim.clock() - virtual_start) / wall)
+    sim.close()
@@ -0,0 +1,144 @@
+'''
+Monotonic clock for timestamping samples, and the scheduler of the control loop
+Aug 2016
+
+time.time() jumps whenever NTP adjusts the system clock, which makes it
+useless for measuring intervals. Python 2 has no time.monotonic, so on
+Linux we ask the kernel for CLOCK_MONOTONIC directly.
+'''
+
+import ctypes
+import ctypes.util
+import time
+import traceback
+from ringbuffer import RingBuffer
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    CLOCK_MONOTONIC = 1     # see <linux/time.h>
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ''' Seconds from an arbitrary but fixed point, never goes backwards '''
+        t = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class PeriodicScheduler(object):
+    '''
+    Calls func every `period` seconds against monotonic deadlines, so the
+    time func takes does not add up into the period.
+
+    If a tick starts late, the next one is still due on the original grid
+    (catch up). If the loop falls more than `max_late` seconds behind, the
+    missed ticks are skipped rather than run in a burst, and counted.
+
+    An exception in func ends that tick, not the loop: it is printed and
+    counted (errors, and 'swallowed_exceptions' of stats), and the next
+    tick runs as usual.
+
+    The start jitter (start - deadline) and the duration of every tick go
+    into a ring buffer, width 2, for later inspection, and into the
+    'tick_jitter' and 'tick' histograms of stats if given (see
+    instrumentation.py).
+    '''
+
+    def __init__(self, period, func, max_late=None, clock=monotonic, sleep=time.sleep, history=1024, stats=None):
+        self.period = float(period)
+        self.func = func
+        self.max_late = self.period if max_late is None else max_late
+        self.clock = clock
+        self.sleep = sleep
+        self.history = RingBuffer(history, 2)   # (jitter, duration) per tick
+        self.instruments = stats     # (stats() is taken by the summary below)
+        self.ticks = 0
+        self.overruns = 0   # Ticks that took longer than the period
+        self.skipped = 0    # Deadlines dropped because we were too far behind
+        self.errors = 0     # Ticks ended by an exception
+
+    def run(self, stop):
+        ''' Tick until stop() returns True '''
+        deadline = self.clock()
+        while not stop():
+            now = self.clock()
+            if deadline > now:
+                self.sleep(deadline - now)
+                now = self.clock()
+            try:
+                self.func()
+            except Exception:
+                traceback.print_exc()
+                self.errors += 1
+                if self.instruments is not None:
+                    self.instruments.count('swallowed_exceptions')
+            end = self.clock()
+
+            self.ticks += 1
+            self.history.push(now, (now - deadline, end - now))
+            if self.instruments is not None:
+                self.instruments.record('tick_jitter', now - deadline)
+                self.instruments.record('tick', end - now)
+            if end - now > self.period:
+                self.overruns += 1
+
+            deadline += self.period
+            if end - deadline > self.max_late:
+                missed = int((end - deadline) // self.period) + 1
+                deadline += missed * self.period
+                self.skipped += missed
+
+    def stats(self):
+        t, h = self.history.latest(self.history.size)
+        if len(t) == 0:
+            return {'ticks': 0, 'overruns': 0, 'skipped': 0, 'errors': self.errors}
+        return {'ticks': self.ticks, 'overruns': self.overruns, 'skipped': self.skipped, 'errors': self.errors,
+                'jitter_last': float(h[-1, 0]), 'jitter_max': float(h[:, 0].max()),
+                'jitter_rms': float((h[:, 0]**2).mean()**0.5), 'duration_max': float(h[:, 1].max())}
+
+
+class VirtualClock(object):
+    '''
+    Simulated time for running the controller faster than real time. Call it
+    for the current time, and use its sleep() in place of time.sleep: sleep
+    advances the time and lets the listeners (simulated devices) catch up.
+
+    With speed=None, time advances as fast as the CPU allows. Otherwise
+    sleep() also waits until the real time (from the first sleep) has caught
+    up with the virtual time / speed, e.g. speed=100 for 100x: the time the
+    ticks take in between counts towards the pace. A speed faster than the
+    CPU allows only means unpaced (the demo of cavity_sim.py manages a few
+    hundred x), so the virtual time falls behind and never bursts to catch up.
+    '''
+
+    def __init__(self, start=0., speed=None):
+        self.now = float(start)
+        self.speed = speed
+        self.pace_start = None  # (real, virtual) time of the first sleep, with a speed
+        self.listeners = []     # Called with the new time whenever it advances
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, dt):
+        if dt <= 0:
+            return
+        if self.speed:
+            real = monotonic()
+            if self.pace_start is None or real - self.pace_start[0] > (self.now - self.pace_start[1]) / self.speed + 1.:
+                self.pace_start = (real, self.now)     # First sleep, or more than 1 s behind: pace from here
+            wait = self.pace_start[0] + (self.now + dt - self.pace_start[1]) / self.speed - real
+            if wait > 0:
+                time.sleep(wait)
+        self.now += dt
+        for listener in self.listeners:
+            listener(self.now)
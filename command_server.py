@@ -0,0 +1,126 @@
+'''
+Multi-client command server for the retreat controller
+Aug 2016
+
+A zmq ROUTER socket, so any number of REQ clients (lock_requester.py,
+shutdown.py, the sequencer, monitoring scripts) can talk to the controller
+at the same time. Requests are handed to a small pool of worker threads,
+so a slow request does not hold up the others, and the replies are sent
+back from the socket thread (zmq sockets are not thread safe) through an
+inproc PULL socket.
+
+Every request gets exactly one reply: the handler's, or TIMEOUT_REPLY if
+the handler takes longer than the timeout (a late reply is dropped).
+'''
+
+import itertools
+import threading
+import Queue
+import zmq
+
+from clock import monotonic
+
+TIMEOUT_REPLY = "Request Timeout"
+ERROR_REPLY = "Speak Properly"
+
+
+class CommandServer(object):
+
+    def __init__(self, context, address, handler, workers=4, timeout=5., stats=None):
+        self.context = context
+        self.address = address
+        self.handler = handler          # Takes the message string, returns the reply string
+        self.num_workers = workers
+        self.timeout = timeout
+        self.inproc = 'inproc://command-replies-%x' % id(self)
+        self.requests = Queue.Queue()
+        self.pending = {}               # request id -> (client envelope, deadline)
+        self.request_ids = itertools.count()
+        self.served = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.running = 0
+        self.stats = stats              # Handler latency and request counters (see instrumentation.py)
+
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(self.address)
+        self.replies = self.context.socket(zmq.PULL)
+        self.replies.bind(self.inproc)
+
+    def start(self):
+        self.running = 1
+        self.workers = []
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.workerThread)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.thread = threading.Thread(target=self.serverThread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = 0
+        for worker in self.workers:
+            self.requests.put(None)
+        self.thread.join()
+
+    def serverThread(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.replies, zmq.POLLIN)
+        # On stop, keep going until every pending request got its reply (or timed out)
+        while self.running or self.pending:
+            events = dict(poller.poll(100))
+
+            if self.socket in events and self.running:
+                frames = self.socket.recv_multipart()
+                # REQ clients send [identity, '', message]
+                envelope, message = frames[:-1], frames[-1]
+                request_id = next(self.request_ids)
+                self.pending[request_id] = (envelope, monotonic() + self.timeout)
+                self.requests.put((request_id, message))
+
+            if self.replies in events:
+                request_id, reply = self.replies.recv_pyobj()
+                if request_id in self.pending:
+                    envelope, deadline = self.pending.pop(request_id)
+                    self.socket.send_multipart(envelope + [reply])
+                    self.served += 1
+                    if self.stats is not None:
+                        self.stats.count('requests')
+
+            # Answer the requests whose handler is taking too long
+            now = monotonic()
+            for request_id, (envelope, deadline) in self.pending.items():
+                if now > deadline:
+                    del self.pending[request_id]
+                    self.socket.send_multipart(envelope + [TIMEOUT_REPLY])
+                    self.timeouts += 1
+                    if self.stats is not None:
+                        self.stats.count('request_timeouts')
+
+        self.socket.close(linger=0)
+        self.replies.close(linger=0)
+
+    def workerThread(self):
+        push = self.context.socket(zmq.PUSH)
+        push.connect(self.inproc)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            request_id, message = request
+            start = monotonic()
+            try:
+                reply = self.handler(message)
+            except Exception as e:
+                print "Error while handling", repr(message), ":", e
+                self.errors += 1
+                if self.stats is not None:
+                    self.stats.count('swallowed_exceptions')
+                reply = ERROR_REPLY
+            if self.stats is not None:
+                self.stats.record('request', monotonic() - start)
+            push.send_pyobj((request_id, reply))
+        push.close(linger=0)
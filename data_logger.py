@@ -0,0 +1,234 @@
+'''
+Append-only binary log of the retreat controller: counter samples, ticks and lock events
+Aug 2016
+
+The file holds several streams (tables) of fixed columns. Rows are
+buffered in memory and appended as chunks, every flush_interval seconds or
+chunk_rows rows, whichever comes first, so a crash loses at most the last
+few seconds. Inside a chunk the data is columnar: each column is one
+contiguous array, so the reader maps the file and hands out NumPy views
+without parsing anything but the chunk headers.
+
+Format (little-endian):
+    magic 'RCLOG001', uint32 length, JSON header of that length (padded with
+    spaces so that the chunks start on 8 bytes):
+        {"streams": [[name, [[column, dtype(, width)], ...]], ...], "metadata": {...}}
+        The first column of every stream is its time (float64, s).
+    then chunks, each:
+        'CHNK', uint16 stream index, uint16 0, uint32 rows, float64 first and last time,
+        4 bytes padding, then every column in order (rows x width items),
+        each padded to 8 bytes.
+A chunk cut short at the end of the file (crash during a write) is ignored.
+
+Usage:
+    log = LogReader('retreat.rclog')
+    ticks = log.read('ticks', start, stop)      # dict of column: array
+    ticks['output'][:, 5]                       # V6
+
+Run this file on a log for a summary of its streams.
+'''
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+from clock import monotonic
+
+MAGIC = b'RCLOG001'
+CHUNK = struct.Struct('<4sHHIdd4x')
+CHUNK_MAGIC = b'CHNK'
+
+
+class _Stream(object):
+
+    def __init__(self, index, name, columns):
+        self.index = index
+        self.name = name
+        self.columns = [column[0] for column in columns]
+        self.dtypes = [np.dtype(column[1]).newbyteorder('<') for column in columns]
+        self.widths = [column[2] if len(column) > 2 else 1 for column in columns]
+
+    def column_sizes(self, rows):
+        # Bytes of every column of a chunk of rows, padded to 8
+        return [(rows * width * dtype.itemsize + 7) // 8 * 8 for dtype, width in zip(self.dtypes, self.widths)]
+
+
+def _parse_header(streams):
+    return [_Stream(index, name, columns) for index, (name, columns) in enumerate(streams)]
+
+
+class LogWriter(object):
+    '''
+    Appends rows to a new log file (OSError if path already exists: a log
+    is never overwritten). streams is a list of (name, columns) with
+    columns a list of (column, dtype) or (column, dtype, width); metadata is
+    stored in the header as is (must be JSON serialisable).
+    '''
+
+    def __init__(self, path, streams, flush_interval=10., chunk_rows=4096, clock=monotonic, metadata=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chunk_rows = chunk_rows
+        self.clock = clock
+        self.streams = dict((stream.name, stream) for stream in _parse_header(streams))
+        self.pending = dict((name, [[] for column in stream.columns]) for name, stream in self.streams.items())
+        self.rows = dict((name, 0) for name in self.streams)
+        self.bytes_written = 0
+
+        metadata = dict(metadata or {})
+        # To turn the (monotonic) times of the log into dates
+        metadata.setdefault('wall_time_offset', time.time() - clock())
+        header = json.dumps({'streams': streams, 'metadata': metadata}).encode('utf-8')
+        # Pad the header with spaces so that the chunks (and their columns) start on 8 bytes
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+        self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), 'wb')
+        self._write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.file.flush()
+        self.last_flush = clock()
+
+    def _write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def append(self, name, row):
+        ''' Add one row: a value (or sequence of width values) per column '''
+        for column, value in zip(self.pending[name], row):
+            column.append(value)
+        self.rows[name] += 1
+        self._maybe_flush(name)
+
+    def extend(self, name, columns):
+        ''' Add many rows: an array (rows, or rows x width) per column '''
+        n = len(columns[0])
+        if n == 0:
+            return
+        for column, values in zip(self.pending[name], columns):
+            column.append(np.asarray(values))
+        self.rows[name] += n
+        self._maybe_flush(name)
+
+    def _maybe_flush(self, name):
+        if self.rows[name] >= self.chunk_rows or self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _columns(self, stream):
+        # The pending values of every column as one array each (rows and arrays may be mixed)
+        columns = []
+        for values, dtype, width in zip(self.pending[stream.name], stream.dtypes, stream.widths):
+            pieces = [np.asarray(value, dtype=dtype).reshape(-1, width) if isinstance(value, np.ndarray)
+                      else np.asarray([value], dtype=dtype).reshape(1, width) for value in values]
+            columns.append(np.concatenate(pieces))
+        return columns
+
+    def flush(self):
+        ''' Write whatever is pending as one chunk per stream '''
+        for name, stream in self.streams.items():
+            rows = self.rows[name]
+            if not rows:
+                continue
+            columns = self._columns(stream)
+            times = columns[0][:, 0]
+            self._write(CHUNK.pack(CHUNK_MAGIC, stream.index, 0, rows, times[0], times[-1]))
+            for column, size in zip(columns, stream.column_sizes(rows)):
+                data = column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+                self._write(data + b'\0' * (size - len(data)))
+            self.pending[name] = [[] for column in stream.columns]
+            self.rows[name] = 0
+        self.file.flush()
+        self.last_flush = self.clock()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class LogReader(object):
+    ''' Memory maps a log and reads time ranges of its streams without loading the rest '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + ' is not a retreat controller log')
+        length, = struct.unpack_from('<I', self.map, len(MAGIC))
+        offset = len(MAGIC) + 4
+        header = json.loads(self.map[offset:offset + length].decode('utf-8'))
+        self.metadata = header['metadata']
+        self.stream_list = _parse_header(header['streams'])
+        self.streams = dict((stream.name, stream) for stream in self.stream_list)
+        # Chunks per stream: (first time, last time, offset of the data, rows)
+        self.chunks = dict((stream.name, []) for stream in self.stream_list)
+        self._index(offset + length)
+
+    def _index(self, offset):
+        size = len(self.map)
+        while offset + CHUNK.size <= size:
+            magic, index, unused, rows, first, last = CHUNK.unpack_from(self.map, offset)
+            if magic != CHUNK_MAGIC or index >= len(self.stream_list):
+                break
+            stream = self.stream_list[index]
+            end = offset + CHUNK.size + sum(stream.column_sizes(rows))
+            if end > size:
+                break   # Cut short
+            self.chunks[stream.name].append((first, last, offset + CHUNK.size, rows))
+            offset = end
+
+    def time_range(self, name):
+        chunks = self.chunks[name]
+        if not chunks:
+            return None
+        return chunks[0][0], chunks[-1][1]
+
+    def rows(self, name):
+        return sum([chunk[3] for chunk in self.chunks[name]])
+
+    def read(self, name, start=None, stop=None):
+        '''
+        The rows of a stream with start <= time < stop (None for no bound),
+        as a dict of column: array (rows, or rows x width)
+        '''
+        stream = self.streams[name]
+        start = -np.inf if start is None else start
+        stop = np.inf if stop is None else stop
+        pieces = [[] for column in stream.columns]
+        for first, last, offset, rows in self.chunks[name]:
+            if last < start or first >= stop:
+                continue
+            views = []
+            for dtype, width, size in zip(stream.dtypes, stream.widths, stream.column_sizes(rows)):
+                views.append(np.frombuffer(self.map, dtype, rows * width, offset).reshape(rows, width))
+                offset += size
+            times = views[0][:, 0]
+            selected = slice(np.searchsorted(times, start), np.searchsorted(times, stop))
+            for piece, view in zip(pieces, views):
+                piece.append(view[selected])
+        result = {}
+        for column, dtype, width, piece in zip(stream.columns, stream.dtypes, stream.widths, pieces):
+            values = np.concatenate(piece) if piece else np.zeros((0, width), dtype)
+            result[column] = values[:, 0] if width == 1 else values
+        return result
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+if __name__ == '__main__':
+    log = LogReader(sys.argv[1])
+    offset = log.metadata.get('wall_time_offset', 0)
+    for stream in log.stream_list:
+        time_range = log.time_range(stream.name)
+        if time_range is None:
+            print "%-10s empty" % stream.name
+            continue
+        print "%-10s %9d rows in %4d chunks, %s to %s (%.0f s)" % (
+            stream.name, log.rows(stream.name), len(log.chunks[stream.name]),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time_range[0] + offset)),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time_range[1] + offset)), time_range[1] - time_range[0])
+        print "           columns:", ', '.join(stream.columns)
+    log.close()
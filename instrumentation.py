@@ -0,0 +1,100 @@
+'''
+Latency histograms and event counters for the retreat controller
+Aug 2016
+
+Cheap enough to stay on all the time: recording a latency is a bisect into
+fixed buckets and a few additions under a lock, counting an event is one
+addition. Every thread (control loop, acquisition, command server
+workers) records into the same Stats, and snapshot() returns everything
+as a JSON-friendly dict for the Check Stats command and the GUI.
+
+Times are in seconds. The buckets go from 10 us to 10 s, 1-2-5 per decade;
+the last bucket counts everything above 10 s.
+'''
+
+import bisect
+import collections
+import threading
+
+from clock import monotonic
+
+BUCKETS = [m * 10.**e for e in range(-5, 1) for m in (1, 2, 5)] + [10.]
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, q):
+        # Upper edge of the bucket holding the q-th percentile (the max for the last bucket)
+        if not self.count:
+            return 0.
+        rank = q / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.,
+                'max': self.max, 'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': self.counts}
+
+
+class Stats(object):
+    '''
+    Named latency histograms (record) and counters (count). The rates of
+    the counters are over the last `window` seconds, from the totals that
+    sample() keeps once per second (the control loop calls it every tick).
+    '''
+
+    def __init__(self, clock=monotonic, window=10):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.start_time = clock()
+        self.history = collections.deque(maxlen=window + 1)    # (time, counters) once per second
+        self.history.append((self.start_time, {}))
+
+    def record(self, name, duration):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(duration)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def sample(self):
+        now = self.clock()
+        if now - self.history[-1][0] >= 1:
+            with self.lock:
+                self.history.append((now, dict(self.counters)))
+
+    def snapshot(self):
+        with self.lock:
+            now = self.clock()
+            then, old = self.history[0]
+            elapsed = now - then
+            return {'uptime': now - self.start_time,
+                    'buckets': BUCKETS,
+                    'latency': dict((name, histogram.snapshot()) for name, histogram in self.histograms.items()),
+                    'counters': dict(self.counters),
+                    'rates': dict((name, (total - old.get(name, 0)) / elapsed if elapsed > 0 else 0.)
+                                  for name, total in self.counters.items())}
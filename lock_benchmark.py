@@ -0,0 +1,226 @@
+'''
+Lock acquisition benchmark of the retreat controller, on the simulated cavity
+Aug 2016
+
+Every trial knocks the cavity off resonance in V5/V6 and asks for the lock
+the way the lab does (Please Lock, then Check Lock), with the real locking
+state machine and lock optimizer of retreat_controller.py. For every
+optimizer it reports:
+- time_to_lock: distribution of the times from Please Lock to Locked (s)
+- success_rate: fraction of the trials locked before the optimizer gives up
+  (MAX_LOCKING_TRIES / LOCK_TIME_BUDGET)
+- dac_writes: DAC transactions per trial, from Please Lock to the end
+- overshoot: how far V5/V6 went beyond their final value, per trial (V)
+
+All optimizers see the same kicks. The results go to a JSON file. Given a
+baseline (an earlier results file), the script exits with status 1 if an
+optimizer got worse than the tolerance, so it can guard changes before
+they go into the lab.
+
+The resonance can also follow a recorded trace instead of standing still:
+a text file with columns time (s), V5 and V6 resonance offsets (V), e.g.
+from the lock offsets in the telemetry of a locked cavity.
+
+Usage:
+    python lock_benchmark.py --trials 50 --output results.json
+    python lock_benchmark.py --optimizers simplex golden --baseline results.json
+'''
+
+import sys
+import os
+import time
+import json
+import argparse
+import numpy as np
+
+import cavity_sim
+import retreat_controller as rc
+from trajectory import PROFILES
+from Counter import AdaptiveGate
+
+THRESHOLD_RATE = 30000      # counts/s, threshold of the lock (the peak is 50000 + 500 background)
+KICK_RANGE = (0.02, 0.05)   # V, size of the kick in each of V5 and V6 (random sign)
+SETTLE_TIME = 2             # s between the kick and Please Lock
+CHECK_DELAY = 1             # s between Please Lock and the first Check Lock
+
+
+class RecordedDriftPlant(cavity_sim.CavityPlant):
+    ''' Cavity whose V5/V6 resonance follows a recorded trace (time, V5, V6 offsets), looped '''
+
+    def __init__(self, trace, **kwargs):
+        cavity_sim.CavityPlant.__init__(self, **kwargs)
+        self.trace_time = trace[:, 0] - trace[0, 0]
+        self.trace_offsets = trace[:, 1:3] - trace[0, 1:3]
+        self.base_center = self.center.copy()
+
+    def kick(self, offsets):
+        self.base_center = self.base_center + np.array(offsets, dtype=float)
+        self.center = self.center + np.array(offsets, dtype=float)
+
+    def centers(self, t):
+        t_trace = np.asarray(t) % self.trace_time[-1] if self.trace_time[-1] > 0 else np.zeros(len(t))
+        centers = np.tile(self.base_center, (len(t), 1))
+        centers[:, 4] += np.interp(t_trace, self.trace_time, self.trace_offsets[:, 0])
+        centers[:, 5] += np.interp(t_trace, self.trace_time, self.trace_offsets[:, 1])
+        self.center = centers[-1]
+        self.time = t[-1]
+        return centers
+
+
+def overshoot(trajectory):
+    '''
+    How far a trajectory (1D array, first value is the start) went beyond
+    its final value, in the direction it moved. If it ended where it
+    started, any excursion counts.
+    '''
+    start, final = trajectory[0], trajectory[-1]
+    if final == start:
+        return float(np.abs(trajectory - final).max())
+    return float(max(0, ((trajectory - final) * np.sign(final - start)).max()))
+
+
+def summary(values):
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=float)
+    return {'mean': float(values.mean()), 'median': float(np.median(values)),
+            'p90': float(np.percentile(values, 90)), 'max': float(values.max()), 'min': float(values.min())}
+
+
+def run_trial(sim, kick):
+    ''' One lock acquisition after a kick, returns the measurements of the trial '''
+    controller = sim.controller
+    sim.plant.kick(kick)
+    sim.run(SETTLE_TIME)
+
+    # Record V5/V6 after every tick (the until() of run is checked once per tick)
+    trajectory = [[controller.output_value[5], controller.output_value[6]]]
+    def record():
+        trajectory.append([controller.output_value[5], controller.output_value[6]])
+        return False
+
+    writes = sim.dac.writes
+    start = sim.clock()
+    controller.handleMessage("Please Lock")
+    sim.run(CHECK_DELAY, until=record)
+    sim.run(rc.LOCK_TIME_BUDGET + 10, until=lambda: record() or controller.lock_process not in (1, 4))
+    reply = controller.handleMessage("Check Lock")
+
+    trajectory = np.array(trajectory)
+    return {'reply': reply,
+            'locked': reply == "Lock Successful",
+            'time_to_lock': controller.time_to_lock,
+            'duration': sim.clock() - start,
+            'iterations': controller.optimizer.iterations,
+            'dac_writes': sim.dac.writes - writes,
+            'overshoot': [overshoot(trajectory[:, 0]), overshoot(trajectory[:, 1])]}
+
+
+def benchmark(optimizer, kicks, seed, trace=None, playback_step=None, adaptive_gate=None):
+    ''' All the trials of one optimizer on a fresh simulation '''
+    if trace is None:
+        plant = cavity_sim.CavityPlant(seed=seed)
+    else:
+        plant = RecordedDriftPlant(trace, seed=seed)
+    sim = cavity_sim.Simulation(plant, rc.GATE_TIME, playback_step=playback_step, adaptive_gate=adaptive_gate)
+    controller = sim.controller
+    controller.setOptimizer(optimizer)
+    controller.set_value[0] = THRESHOLD_RATE * rc.GATE_TIME
+    sim.run(2)
+    controller.setLockStatus(1)
+    sim.run(1)
+
+    wall_start = time.time()
+    virtual_start = sim.clock()
+    trials = [run_trial(sim, kick) for kick in kicks]
+    wall = time.time() - wall_start
+    sim.close()
+
+    locked = [trial for trial in trials if trial['locked']]
+    return {'trials': len(trials),
+            'success_rate': len(locked) / float(len(trials)),
+            'time_to_lock': summary([trial['time_to_lock'] for trial in locked]),
+            'iterations': summary([trial['iterations'] for trial in locked]),
+            'dac_writes': summary([trial['dac_writes'] for trial in trials]),
+            'overshoot': {'V5': summary([trial['overshoot'][0] for trial in trials]),
+                          'V6': summary([trial['overshoot'][1] for trial in trials])},
+            'virtual_time': sim.clock() - virtual_start,
+            'wall_time': wall,
+            'per_trial': trials}
+
+
+def regressions(results, baseline, tolerance):
+    ''' What got worse than the baseline by more than tolerance (relative), as messages '''
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result['success_rate'] < old['success_rate'] - tolerance:
+            found.append("%s: success rate %.2f, was %.2f" % (name, result['success_rate'], old['success_rate']))
+        for key in ('time_to_lock', 'dac_writes'):
+            if result[key] and old[key] and result[key]['median'] > old[key]['median'] * (1 + tolerance):
+                found.append("%s: median %s %.1f, was %.1f" % (name, key, result[key]['median'], old[key]['median']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lock acquisition on the simulated cavity')
+    parser.add_argument('--optimizers', nargs='+', default=sorted(rc.OPTIMIZERS), choices=sorted(rc.OPTIMIZERS))
+    parser.add_argument('--trials', type=int, default=20, help='lock acquisitions per optimizer')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--trace', help='recorded resonance trace: columns time, V5, V6 offsets')
+    parser.add_argument('--ramp-profile', default=rc.RAMP_PROFILE, choices=PROFILES, help='shape of the voltage ramps')
+    parser.add_argument('--playback-step', type=float, help='let the simulated DAC play the ramps at this step (s)')
+    parser.add_argument('--adaptive-gate', action='store_true', help='adaptive counter gate time (ADAPTIVE_GATE_PARAMS)')
+    parser.add_argument('--output', default='lock_benchmark.json', help='results file (JSON)')
+    parser.add_argument('--baseline', help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    random = np.random.RandomState(args.seed)
+    kicks = [[0, 0, 0, 0] + list(random.choice([-1, 1], 2) * random.uniform(KICK_RANGE[0], KICK_RANGE[1], 2))
+             for trial in range(args.trials)]
+    trace = np.loadtxt(args.trace, ndmin=2) if args.trace else None
+    rc.RAMP_PROFILE = args.ramp_profile
+    adaptive_gate = AdaptiveGate(**rc.ADAPTIVE_GATE_PARAMS) if args.adaptive_gate else None
+
+    results = {}
+    for name in args.optimizers:
+        # The controller is chatty, keep the report readable
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            results[name] = benchmark(name, kicks, args.seed, trace, args.playback_step, adaptive_gate)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result = results[name]
+        ttl = result['time_to_lock']
+        print "%-10s success %3.0f%%  time to lock median %5.1f s, p90 %5.1f s  DAC writes median %5.0f  overshoot V5/V6 max %.3f/%.3f V" % (
+            name, 100 * result['success_rate'], ttl['median'] if ttl else float('nan'), ttl['p90'] if ttl else float('nan'),
+            result['dac_writes']['median'], result['overshoot']['V5']['max'], result['overshoot']['V6']['max'])
+
+    report = {'config': {'trials': args.trials, 'seed': args.seed, 'trace': args.trace,
+                         'ramp_profile': args.ramp_profile, 'playback_step': args.playback_step,
+                         'adaptive_gate': rc.ADAPTIVE_GATE_PARAMS if args.adaptive_gate else None,
+                         'threshold_rate': THRESHOLD_RATE, 'kick_range': KICK_RANGE,
+                         'tick_period': rc.TICK_PERIOD, 'count_filter': rc.COUNT_FILTER,
+                         'count_filter_params': rc.COUNT_FILTER_PARAMS, 'lock_time_budget': rc.LOCK_TIME_BUDGET},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print "Results written to", args.output
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        found = regressions(results, baseline, args.tolerance)
+        for message in found:
+            print "REGRESSION", message
+        if found:
+            sys.exit(1)
+        print "No regression against", args.baseline
+
+
+if __name__ == '__main__':
+    main()
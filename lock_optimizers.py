@@ -0,0 +1,221 @@
+'''
+Lock acquisition optimizers for the slow lock of the retreat controller
+Aug 2016
+
+The controller measures the (filtered) counts at the current V5/V6 offsets,
+hands them to the optimizer, applies the offsets it asks for next, waits
+for the filter to settle (LOCKING_DELAY) and repeats, until the counts
+reach the lock target or the optimizer gives up.
+
+Every optimizer is written as a generator that yields the [V5, V6] offsets
+it wants measured next and receives the counts measured there. They all
+maximise the counts.
+
+Usage:
+    optimizer = make_optimizer('simplex', step=0.002, max_evaluations=90)
+    offsets = optimizer.reset(offsets)          # Start a new search
+    offsets = optimizer.step(offsets, counts)   # None when giving up
+'''
+
+import math
+
+INVPHI = (math.sqrt(5) - 1) / 2     # 1/golden ratio
+
+
+class LockOptimizer(object):
+
+    def __init__(self, step, max_evaluations, bounds=(-1, 1)):
+        self.step_size = step
+        self.max_evaluations = max_evaluations
+        self.bounds = bounds
+        self.iterations = 0
+        self.search = None
+
+    def _clip(self, offsets):
+        return [min(max(v, self.bounds[0]), self.bounds[1]) for v in offsets]
+
+    def reset(self, offsets):
+        ''' Start a new search from offsets, returns the first offsets to measure '''
+        self.iterations = 0
+        self.search = self.search_from(list(offsets))
+        return self._clip(next(self.search))
+
+    def step(self, offsets, value):
+        '''
+        Give the counts measured at the offsets asked for last time, returns
+        the next offsets to measure, or None if the search has given up.
+        '''
+        self.iterations += 1
+        if self.iterations >= self.max_evaluations:
+            return None
+        try:
+            return self._clip(self.search.send(value))
+        except StopIteration:
+            return None
+
+    def search_from(self, offsets):
+        raise NotImplementedError
+
+
+class HillClimbOptimizer(LockOptimizer):
+    '''
+    Fixed step hill climb along one offset at a time: keep stepping in the
+    same direction while the counts improve, reverse when they get worse.
+    Switches between V6 and V5 after axis_evaluations[1] or [0] steps, for
+    `tries` switches. This is the original slow lock.
+    '''
+
+    def __init__(self, step, max_evaluations, bounds=(-1, 1), axis_evaluations=(10, 20), tries=6):
+        LockOptimizer.__init__(self, step, max_evaluations, bounds)
+        self.axis_evaluations = axis_evaluations
+        self.tries = tries
+
+    def search_from(self, offsets):
+        value = yield list(offsets)
+        direction = 1
+        axis = 1    # Starts from voltage 6
+        for trial in range(self.tries):
+            for i in range(self.axis_evaluations[axis]):
+                offsets[axis] += self.step_size * direction
+                new_value = yield list(offsets)
+                if new_value < value:
+                    direction = -direction
+                value = new_value
+            axis = 1 - axis
+
+
+class LineSearchOptimizer(LockOptimizer):
+    '''
+    Adaptive step line search along one offset at a time: the step doubles
+    (up to max_step) while the counts improve, and halves with a reversal
+    when they don't. Once the step is below min_step the offset is taken as
+    optimised and the search goes on along the other one.
+    '''
+
+    def __init__(self, step, max_evaluations, bounds=(-1, 1), max_step=None, min_step=None):
+        LockOptimizer.__init__(self, step, max_evaluations, bounds)
+        self.max_step = 16*step if max_step is None else max_step
+        self.min_step = step/4. if min_step is None else min_step
+
+    def search_from(self, offsets):
+        axis = 1
+        while True:
+            # Measure again where we are, the counts may have drifted
+            value = yield list(offsets)
+            step = self.step_size
+            direction = 1
+            while step >= self.min_step:
+                trial = list(offsets)
+                trial[axis] += direction * step
+                new_value = yield trial
+                if new_value > value:
+                    offsets, value = trial, new_value
+                    step = min(2*step, self.max_step)
+                else:
+                    direction = -direction
+                    step /= 2.
+            axis = 1 - axis
+
+
+class GoldenSectionOptimizer(LockOptimizer):
+    '''
+    Golden section search along one offset at a time, over +-span around the
+    current offsets, down to a bracket of tol. Alternates between V6 and V5,
+    halving the span every round.
+    '''
+
+    def __init__(self, step, max_evaluations, bounds=(-1, 1), span=None, tol=None):
+        LockOptimizer.__init__(self, step, max_evaluations, bounds)
+        self.span = 25*step if span is None else span
+        self.tol = step if tol is None else tol
+
+    def search_from(self, offsets):
+        axis = 1
+        span = self.span
+
+        def at(x):
+            point = list(offsets)
+            point[axis] = x
+            return point
+
+        while True:
+            a, b = offsets[axis] - span, offsets[axis] + span
+            c, d = b - INVPHI*(b - a), a + INVPHI*(b - a)
+            fc = yield at(c)
+            fd = yield at(d)
+            while b - a > self.tol:
+                if fc > fd:
+                    b, d, fd = d, c, fc
+                    c = b - INVPHI*(b - a)
+                    fc = yield at(c)
+                else:
+                    a, c, fc = c, d, fd
+                    d = a + INVPHI*(b - a)
+                    fd = yield at(d)
+            offsets[axis] = c if fc > fd else d
+            axis = 1 - axis
+            span = max(span/2., 2*self.tol)
+
+
+class SimplexOptimizer(LockOptimizer):
+    '''
+    Nelder-Mead simplex over (V5, V6) together. The first simplex has sides
+    of `size`; when it has shrunk below tol it is rebuilt around the best
+    point, so the search keeps going until the lock is found or the budget
+    is spent.
+    '''
+
+    def __init__(self, step, max_evaluations, bounds=(-1, 1), size=None, tol=None):
+        LockOptimizer.__init__(self, step, max_evaluations, bounds)
+        self.size = 5*step if size is None else size
+        self.tol = step/2. if tol is None else tol
+
+    def search_from(self, offsets):
+        best = list(offsets)
+        while True:
+            simplex = [best, [best[0] + self.size, best[1]], [best[0], best[1] + self.size]]
+            values = []
+            for point in simplex:
+                value = yield list(point)
+                values.append(value)
+
+            while True:
+                # Sort from best (highest counts) to worst
+                order = sorted(range(3), key=lambda i: -values[i])
+                simplex = [simplex[i] for i in order]
+                values = [values[i] for i in order]
+                size = max(abs(simplex[i][k] - simplex[0][k]) for i in (1, 2) for k in (0, 1))
+                if size < self.tol:
+                    break
+
+                centroid = [(simplex[0][k] + simplex[1][k]) / 2. for k in (0, 1)]
+                worst = simplex[2]
+                reflected = [2*centroid[k] - worst[k] for k in (0, 1)]
+                f_reflected = yield reflected
+                if f_reflected > values[0]:
+                    expanded = [3*centroid[k] - 2*worst[k] for k in (0, 1)]
+                    f_expanded = yield expanded
+                    if f_expanded > f_reflected:
+                        simplex[2], values[2] = expanded, f_expanded
+                    else:
+                        simplex[2], values[2] = reflected, f_reflected
+                elif f_reflected > values[1]:
+                    simplex[2], values[2] = reflected, f_reflected
+                else:
+                    contracted = [(centroid[k] + worst[k]) / 2. for k in (0, 1)]
+                    f_contracted = yield contracted
+                    if f_contracted > values[2]:
+                        simplex[2], values[2] = contracted, f_contracted
+                    else:
+                        # Shrink towards the best point
+                        for i in (1, 2):
+                            simplex[i] = [(simplex[0][k] + simplex[i][k]) / 2. for k in (0, 1)]
+                            values[i] = yield list(simplex[i])
+            best = simplex[0]
+
+
+OPTIMIZERS = {'hillclimb': HillClimbOptimizer, 'linesearch': LineSearchOptimizer,
+              'golden': GoldenSectionOptimizer, 'simplex': SimplexOptimizer}
+
+def make_optimizer(name, step, max_evaluations, **kwargs):
+    return OPTIMIZERS[name](step, max_evaluations, **kwargs)
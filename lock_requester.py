@@ -21,6 +21,27 @@ List of commands:
 	List of reply: "SetVoltX Y", "SetVoltX Undefined"
 - ShiftVoltX Up/Down
 	List of reply: "ShiftVoltX Up", "ShiftVoltX Down", "ShiftVoltX Undefined"
+- SetOptimizer X (X: hillclimb, linesearch, golden, simplex)
+	List of reply: "SetOptimizer X", "SetOptimizer Undefined"
+- Check Optimizer
+	List of reply: "Optimizer X N T" (N iterations of the last search, T its time to lock in s or None)
+- Check Stats
+	Reply: a JSON object with the latency histograms of the control loop stages,
+	the counter and the requests ("latency", in s), the event counters and their
+	rates per s ("counters", "rates") and the scheduler summary ("scheduler")
+
+The server takes many clients at once. Any command can also be answered with
+"Request Timeout" if the controller takes more than 5 s to handle it.
+
+Structured requests: a JSON object with a list of operations, answered with
+one JSON reply holding one result per operation, in order. Example:
+	{"ops": [{"op": "set", "channel": 1, "value": 0.5},
+	         {"op": "shift", "channel": 6, "direction": "up"},
+	         {"op": "get"}, {"op": "get", "channel": 5},
+	         {"op": "lock_state"}, {"op": "optimizer", "name": "simplex"}, {"op": "stats"},
+	         {"op": "text", "command": "Please Lock"}]}
+	Reply: {"results": [{"channel": 1, "set": 0.5}, ..., {"reply": "Okay Boss"}]}
+	A failed operation gives {"error": "..."} in its place.
 '''
 
 
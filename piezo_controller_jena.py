@@ -2,18 +2,37 @@
 Piezosystem jena class
 Author: Adrian Utama
 Aug 2016
+
+The DAC goes through CQTdevices.USBDacProg (usbdacset) and a move
+writes only the axes that change, as one frame. scan() visits a grid of
+positions, raster (nested loops, z fastest) or serpentine (every line
+runs back the way the previous one came, so each move is a single step
+of one axis), waits a settle time that grows with the size of the step,
+and takes the mean counts per gate of a running acquisition (e.g.
+Counter.CountAcquisition, which keeps counting while we wait) over the
+dwell time after settling, as a NumPy grid.
 '''
 
-import subprocess as sp
 import numpy as np
 import time
 
+from clock import monotonic
+from CQTdevices import USBDacProg
+from Counter import Countercomm, CountAcquisition
+
 # DO NOT CHANGE THIS IF YOU DON'T KNOW WHAT YOU ARE DOING
 usbdacprog = '~/programs/usbpatgendriver/testapps/usbdacset'
 dac_add='/dev/ioboards/pattgen_serial_10'
+counter_add='/dev/serial/by-id/usb-Centre_for_Quantum_Technologies_USB_Counter_Ucnt-QO11-if00'
 CHANNEL_X = 4
 CHANNEL_Y = 7
 CHANNEL_Z = 8
+CHANNELS = (CHANNEL_X, CHANNEL_Y, CHANNEL_Z)
+
+# Settle time after a move: SETTLE_MIN + SETTLE_PER_VOLT * largest step, at most SETTLE_MAX
+SETTLE_MIN = 0.05           # s
+SETTLE_PER_VOLT = 1.        # s/V
+SETTLE_MAX = 10.            # s, what every point used to wait
 
 def insanity_check(number, min_value, max_value):
     ''' To check whether the value is out of given range'''
@@ -24,11 +43,24 @@ def insanity_check(number, min_value, max_value):
     else: 
         return number
 
+def scan_path(shape, serpentine=True):
+    ''' Indices of all the points of a grid of the given shape, first axis slowest '''
+    path = [()]
+    for n in shape:
+        points = []
+        for line, prefix in enumerate(path):
+            order = range(n - 1, -1, -1) if serpentine and line % 2 else range(n)
+            points.extend([prefix + (i,) for i in order])
+        path = points
+    return path
+
 class PiezoJena:
-    def __init__(self):
-        self.set_x(0)
-        self.set_x(0)
-        self.set_x(0)
+    def __init__(self, dac=None, clock=monotonic, sleep=time.sleep):
+        self.dac = USBDacProg(dac_add, usbdacprog) if dac is None else dac
+        self.clock = clock
+        self.sleep = sleep
+        self.position = [None, None, None]  # x, y, z as last written
+        self.move(0, 0, 0)
         print "System Ready to go!"
 
     def set_x(self, value):
@@ -48,7 +80,62 @@ class PiezoJena:
 
     def set_dac(self, channel, output_voltage):
         print "set to ", output_voltage
-        sp.call([usbdacprog + " -d " + dac_add + " " + str(channel-1) + " " + '%.3f'%round(output_voltage,3)], shell=True)
+        self.dac.set_voltage(channel-1, round(output_voltage,3))
+        self.position[CHANNELS.index(channel)] = output_voltage
+
+    def move(self, x=None, y=None, z=None):
+        ''' Write the axes that change (None: leave as is) in one frame, returns the largest step (V) '''
+        frame = []
+        step = 0.
+        for axis, value in enumerate((x, y, z)):
+            if value is None:
+                continue
+            value = insanity_check(value,0,10)
+            if value == self.position[axis]:
+                continue
+            # Unknown position (first move): assume the full range
+            step = max(step, abs(value - self.position[axis]) if self.position[axis] is not None else 10.)
+            frame.append((CHANNELS[axis]-1, round(value,3)))
+            self.position[axis] = value
+        if frame:
+            self.dac.set_voltages(frame)
+        return step
+
+    def settle_time(self, step, settle_min=SETTLE_MIN, settle_per_volt=SETTLE_PER_VOLT, settle_max=SETTLE_MAX):
+        if step == 0:
+            return 0.
+        return min(settle_min + settle_per_volt * step, settle_max)
+
+    def scan(self, xs, ys, zs, acquisition=None, dwell=1., serpentine=True, settle_min=SETTLE_MIN,
+             settle_per_volt=SETTLE_PER_VOLT, settle_max=SETTLE_MAX, verbose=False):
+        '''
+        Visit every point of the grid xs by ys by zs (V). Returns an array
+        of that shape with the mean of the acquisition's buffer over the
+        gates that ran entirely within the dwell time (s) after settling at
+        each point; NaN where there was none (or without an acquisition).
+        '''
+        coordinates = [np.atleast_1d(np.asarray(c, dtype=float)) for c in (xs, ys, zs)]
+        shape = tuple([len(c) for c in coordinates])
+        grid = np.empty(shape)
+        grid.fill(np.nan)
+        gate_time = getattr(acquisition, 'gate_time', None) or 0.
+        for index in scan_path(shape, serpentine):
+            point = [c[i] for c, i in zip(coordinates, index)]
+            if verbose:
+                print 'Coordinate', ' '.join(['%g' % v for v in point])
+            step = self.move(*point)
+            if acquisition is not None:
+                cursor = acquisition.buffer.count
+            start = self.clock() + self.settle_time(step, settle_min, settle_per_volt, settle_max)
+            stop = start + dwell
+            self.sleep(max(0., stop - self.clock()))     # The acquisition keeps counting meanwhile
+            if acquisition is None:
+                continue
+            t, values, _ = acquisition.buffer.since(cursor)
+            selected = (t - gate_time >= start) & (t <= stop)
+            if selected.any():
+                grid[index] = values[selected].mean()
+        return grid
 
 
 if __name__ == '__main__':
@@ -68,18 +155,17 @@ if __name__ == '__main__':
 	    z_coor = range(0,11,2)
 
 	    x_coor = [5] #To fix one of the coor
-	    
-	    for x in x_coor:
-		for y in y_coor:
-		    for z in z_coor:
-		        print 'Coordinate',x,y,z
-		        piezo.set_x(x)
-		        piezo.set_y(y)
-		        piezo.set_z(z)
-		        time.sleep(10)
 
-	    piezo.set_x(5)
-	    piezo.set_y(5)
-	    piezo.set_z(5)
+	    counter = Countercomm(counter_add)
+	    counter.set_gate_time(100)
+	    acquisition = CountAcquisition(counter)
+	    acquisition.start()
+	    counts = piezo.scan(x_coor, y_coor, z_coor, acquisition, dwell=1., verbose=True)
+	    acquisition.stop()
+	    print counts
+	    best = np.unravel_index(np.nanargmax(counts), counts.shape)
+	    print 'Most counts at', x_coor[best[0]], y_coor[best[1]], z_coor[best[2]]
+
+	    piezo.move(5, 5, 5)
 	    
     
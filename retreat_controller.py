@@ -4,29 +4,91 @@ Author: Adrian Nugraha Utama
 July 2016
 
 Note: The program uses Multithread with Tkinter. See Python Cookbook: Combining Tkinter and Asynchronous I/O with Threads (Jacob Hallen).
+The control loop runs on its own thread and the GUI only observes it. Run with --headless to go without the GUI.
 '''
 
 
-import Tkinter
 import time
+import math
+import json
 import threading
-import random
+import argparse
+import signal
 import Queue
-import subprocess as sp
 import zmq
-from CQTdevices import AnalogComm
-from Counter import Countercomm
+from CQTdevices import AnalogComm, USBDacProg
+from Counter import Countercomm, CountAcquisition, AdaptiveGate, weighted, ratio
+from signal_filters import make_filter
+from lock_optimizers import make_optimizer, OPTIMIZERS
+from clock import PeriodicScheduler, monotonic
+from command_server import CommandServer
+from data_logger import LogWriter
+from instrumentation import Stats
+from trajectory import plan_trajectory
+try:
+    import Tkinter
+except ImportError:
+    Tkinter = None  # Only the headless mode is available
 
 # BOUNDARIES
 MIN_VALUE_VOLTAGE = -10
 MAX_VALUE_VOLTAGE = 10
-MAX_STEP_VOLTAGE = [0.1, 0.1, 0.1, 0.1, 0.05, 0.05, 0.05] # Max step voltage to increase every refresh rate (100 ms)
+MAX_SLEW_VOLTAGE = [1., 1., 1., 1., 0.5, 0.5, 0.5] # Max rate of change of the output voltages in V/s
+MAX_ACCEL_VOLTAGE = [2., 2., 2., 2., 1., 1., 1.]    # V/s^2, for the 'scurve' and 'jerk' ramps
+MAX_JERK_VOLTAGE = [10., 10., 10., 10., 5., 5., 5.] # V/s^3, for the 'jerk' ramps
+RAMP_PROFILE = 'linear' # Shape of the voltage ramps (see trajectory.py: 'linear', 'scurve', 'jerk')
 MAX_OFFSET_ADJ = 1
 MIN_OFFSET_ADJ = -1
 STEP_OFFSET_ADJ = 0.002
-MAX_LOCKING_STEP = [50,100] #1 step roughly 100 ms. 
+MAX_LOCKING_TIME = [5, 10] # Time in s spent on V5 (0th) or V6 (1st) before trying the other one (hillclimb)
 MAX_LOCKING_TRIES = 6
 
+# LOCK ACQUISITION (see lock_optimizers.py: 'hillclimb', 'linesearch', 'golden', 'simplex')
+LOCK_OPTIMIZER = 'hillclimb'
+# Time after which any optimizer gives up: the time of the MAX_LOCKING_TRIES hillclimb tries, starting from V6
+LOCK_TIME_BUDGET = sum([MAX_LOCKING_TIME[(k+1) % 2] for k in range(MAX_LOCKING_TRIES)])
+
+# CONTROL LOOP
+TICK_PERIOD = 0.1   # s. All the rates above are in seconds, so this can be changed freely
+
+# FILTERING OF THE COUNTS (see signal_filters.py: 'ema', 'mean', 'median', 'outlier')
+COUNT_FILTER = 'ema'
+COUNT_FILTER_PARAMS = {'tau': 0.5}  # Time constant in s for 'ema', use {'window': 0.5} for the others
+
+# COMMAND SERVER
+SERVER_ADDRESS = "tcp://127.0.0.1:5556"
+SERVER_WORKERS = 4      # Requests handled at the same time
+REQUEST_TIMEOUT = 5     # s, after which the client gets "Request Timeout"
+TELEMETRY_ADDRESS = "tcp://127.0.0.1:5557"
+
+# COUNTER CHANNELS
+# Channels read from every COUNTS? reply (one gate for all), and the signal the lock works on,
+# e.g. COUNTER_CHANNELS = [0, 1] with LOCK_SIGNAL = weighted([1, 0.5]) or ratio(0, 1) (see Counter.py)
+COUNTER_CHANNELS = [0]
+LOCK_SIGNAL = None      # None: the first of COUNTER_CHANNELS
+# Range and (rough, fine) steps of the threshold in the GUI, in units of the lock signal:
+# counts per gate by default, use e.g. (0, 10) and (0.1, 0.01) with a ratio
+THRESHOLD_RANGE = (0, 10000)
+THRESHOLD_STEPS = (500, 20)
+
+# COUNTER GATE TIME
+GATE_TIME = 0.03        # s. The counts the lock (and its threshold) sees are always per GATE_TIME
+# With ADAPTIVE_GATE, every gate is the shortest one giving at most this relative shot noise (see Counter.AdaptiveGate):
+# short gates (fast lock) when the cavity is bright, long ones (stable lock) when it is dim
+ADAPTIVE_GATE = False
+ADAPTIVE_GATE_PARAMS = {'target_noise': 0.05, 'min_gate': 0.005, 'max_gate': 0.1}
+
+# DATA LOG (see data_logger.py)
+LOG_PATH_FORMAT = 'retreat_%Y%m%d_%H%M%S.rclog'     # Default log file, strftime format
+LOG_FLUSH_INTERVAL = 10     # s, at most this much of the log is lost in a crash
+LOG_STREAMS = [
+    ('samples', [('time', 'f8'), ('counts', 'f4')]),    # Every counter sample
+    ('ticks', [('time', 'f8'), ('counts', 'f8'), ('set_voltage', 'f4', 6), ('output', 'f4', 6),
+               ('offset_adj', 'f4', 2), ('lock_process', 'i1'), ('set_lock_status', 'i1')]),
+    ('lock', [('time', 'f8'), ('lock_process', 'i1'), ('set_lock_status', 'i1'), ('lock_request', 'i1')]),  # Transitions
+    ('channels', [('time', 'f8'), ('counts', 'i4', len(COUNTER_CHANNELS))]),    # Every gate, all of COUNTER_CHANNELS
+]
+
 # SERIALS
 #analogpm_add='/dev/serial/by-id/usb-Centre_for_Quantum_Technologies_Analog_Mini_IO_Unit_MIO-QO02-if00' # Channel 1
 dac_add='/dev/ioboards/pattgen_serial_10'
@@ -43,27 +105,20 @@ def insanity_check(number, min_value, max_value):
         return number
 
 class GuiPart:
-    def __init__(self, master, queue, endCommand):
-        self.queue = queue
+    """
+    Optional observer of a RetreatController. The buttons change the set
+    values of the controller (or post a command to it), and refresh() copies
+    the state of the controller to the widgets.
+    """
+    def __init__(self, master, controller, endCommand):
+        self.controller = controller
         self.entry = [0,0,0,0,0,0,0]        # 0th item refers to set threshold
-        self.set_value = [0,0,0,0,0,0,0]    # 0th item refers to set threshold
+        self.shown_set_value = [0,0,0,0,0,0,0]  # What the entries currently display
 
         self.label_output = [0,0,0,0,0,0,0]
-        self.output_value = [0,0,0,0,0,0,0]
-
-        # Some parameters for the GUI (Channel 0th: set threshold, 1-6th: set voltage)
-        self.rough_step = [500, 0.3, 0.3, 0.3, 0.3, 0.3, 0.3]       #500
-        self.fine_step = [20, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01] #20
-        self.display_apm = 0
-
-        # Lock Status
-        self.set_lock_status = 0
-        self.lock_target = 0
-        self.lock_process = 0 # 0: No lock, 1: Processing, 2: Locked, 3: ERROR, 4: Out of Lock  
 
         # Voltage Offset adjustment for the lock
         self.label_offset_adj = [0, 0]      # The label array for offset adjust
-        self.display_offset_adj = [0, 0]    # 0th: Voltage 5, 1st: Voltage 6 
 
         # Set up the GUI
 
@@ -78,16 +133,16 @@ class GuiPart:
 
             self.entry[i] = Tkinter.Entry(master, width=10, font=("Helvetica", 16), justify=Tkinter.CENTER)
             self.entry[i].grid(row=i, column=4)
-            self.entry[i].insert(0, '%.3f'%round(self.set_value[i],3))
+            self.entry[i].insert(0, '%.3f'%round(controller.set_value[i],3))
 
-            self.label_output[i] = Tkinter.Label(master, font=("Helvetica", 16), text='Output : '+ '%.3f'%round(self.output_value[i],3), width=12, anchor=Tkinter.W)
+            self.label_output[i] = Tkinter.Label(master, font=("Helvetica", 16), text='Output : '+ '%.3f'%round(controller.output_value[i],3), width=12, anchor=Tkinter.W)
             self.label_output[i].grid(row=i, padx = 5, column=8)
       
         # Some labels for the slow locking            
         Tkinter.Label(master, text='V6 Slow Locking Module', font=("Helvetica", 16)).grid(row=7, padx=5, pady=5, column=1, columnspan=4, sticky=Tkinter.W)
         Tkinter.Label(master, text='Power :', font=("Helvetica", 16)).grid(row=7, column=5, columnspan=2, sticky=Tkinter.W)
 
-        self.label_display_apm = Tkinter.Label(master, font=("Helvetica", 16), text='%.2f'%round(self.display_apm,2), width=12, bg="black", fg="white")
+        self.label_display_apm = Tkinter.Label(master, font=("Helvetica", 16), text='%.2f'%round(controller.display_apm,2), width=12, bg="black", fg="white")
         self.label_display_apm.grid(row=7, column=8, padx=5, pady=5)
 
         # Set threshold
@@ -100,25 +155,32 @@ class GuiPart:
 
         self.entry[0] = Tkinter.Entry(master, width=10, font=("Helvetica", 16), justify=Tkinter.CENTER)
         self.entry[0].grid(row=8, column=4)
-        self.entry[0].insert(0, '%.3f'%round(self.set_value[i],2))
+        self.entry[0].insert(0, '%.3f'%round(controller.set_value[0],3))
 
         # Set locking checkbox
         self.set_lock = Tkinter.IntVar()
-        self.chk_set = Tkinter.Checkbutton(root, text='Set Lock', font=("Helvetica", 16), variable=self.set_lock, command=lambda:self.setLockStatus(self.set_lock.get()))
+        self.chk_set = Tkinter.Checkbutton(master, text='Set Lock', font=("Helvetica", 16), variable=self.set_lock, command=lambda:self.setLockStatus(self.set_lock.get()))
         self.chk_set.grid(row=8, column=8, padx=5, pady=5)
 
         # Locking display parameters
         Tkinter.Label(master, text='Target :', font=("Helvetica", 16)).grid(row=9, padx=5, pady=5, column=4, sticky=Tkinter.E)
-        self.label_lock_target = Tkinter.Label(master, font=("Helvetica", 16), text='%.1f'%round(self.lock_target,1))
+        self.label_lock_target = Tkinter.Label(master, font=("Helvetica", 16), text='%.1f'%round(controller.lock_target,1))
         self.label_lock_target.grid(row=9, column=5, columnspan=2, padx=5, pady=5, sticky=Tkinter.W)
 
         Tkinter.Label(master, text='V5 Offset :', font=("Helvetica", 16)).grid(row=9, padx=5, pady=5, column=1, columnspan=3, sticky=Tkinter.W)
-        self.label_offset_adj[0] = Tkinter.Label(master, font=("Helvetica", 16), text='%.3f'%round(self.display_offset_adj[0],3))
+        self.label_offset_adj[0] = Tkinter.Label(master, font=("Helvetica", 16), text='%.3f'%round(controller.display_offset_adj[0],3))
         self.label_offset_adj[0].grid(row=9, column=2, columnspan=2, padx=5, pady=5, sticky=Tkinter.W)        
         Tkinter.Label(master, text='V6 Offset :', font=("Helvetica", 16)).grid(row=10, padx=5, pady=5, column=1, columnspan=3, sticky=Tkinter.W)
-        self.label_offset_adj[1] = Tkinter.Label(master, font=("Helvetica", 16), text='%.3f'%round(self.display_offset_adj[1],3))
+        self.label_offset_adj[1] = Tkinter.Label(master, font=("Helvetica", 16), text='%.3f'%round(controller.display_offset_adj[1],3))
         self.label_offset_adj[1].grid(row=10, column=2, columnspan=2, padx=5, pady=5, sticky=Tkinter.W)        
 
+        # Lock optimizer selection
+        Tkinter.Label(master, text='Optimizer :', font=("Helvetica", 16)).grid(row=10, column=4, padx=5, pady=5, sticky=Tkinter.E)
+        self.optimizer_name = Tkinter.StringVar()
+        self.optimizer_name.set(controller.optimizer_name)
+        self.menu_optimizer = Tkinter.OptionMenu(master, self.optimizer_name, *sorted(OPTIMIZERS), command=self.setOptimizer)
+        self.menu_optimizer.grid(row=10, column=5, columnspan=2, sticky=Tkinter.W)
+
         # Lock Process Status
         self.label_lock_process = Tkinter.Label(master, font=("Helvetica", 16), text='Starting', width=12, bg="white", fg="black")
         self.label_lock_process.grid(row=9, column=8, padx=5, pady=5, sticky=Tkinter.W)                
@@ -126,372 +188,720 @@ class GuiPart:
         # Misc    
         Tkinter.Button(master, text='Shutdown', font=("Helvetica", 16), command=endCommand).grid(row=10, column=8, columnspan=2, padx=5, pady=5)
 
+        # Control loop statistics (same as Check Stats), refreshed once a second
+        self.label_stats = Tkinter.Label(master, font=("Helvetica", 11), text='', justify=Tkinter.LEFT, anchor=Tkinter.W)
+        self.label_stats.grid(row=11, column=1, columnspan=8, padx=5, pady=5, sticky=Tkinter.W)
+        self.stats_countdown = 0
+
     def buttonPressed(self, channel, button_type):
         # Performing the stuffs for Channel 1 to 6 (Voltage)
+        set_value = self.controller.set_value
         if button_type == 1:
-            self.set_value[channel] -= self.rough_step[channel] 
+            value = set_value[channel] - self.controller.rough_step[channel] 
         elif button_type == 2:
-            self.set_value[channel] -= self.fine_step[channel]
+            value = set_value[channel] - self.controller.fine_step[channel]
         elif button_type == 3:
-            self.set_value[channel] += self.fine_step[channel]
+            value = set_value[channel] + self.controller.fine_step[channel]
         elif button_type == 4:
-            self.set_value[channel] += self.rough_step[channel]
+            value = set_value[channel] + self.controller.rough_step[channel]
 
         if (channel >= 1) and (channel <=6):
-            self.set_value[channel] = insanity_check(self.set_value[channel], MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
+            set_value[channel] = insanity_check(value, MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
         elif channel == 0:
-            self.set_value[channel] = insanity_check(self.set_value[channel], 0, 10000)
+            set_value[channel] = insanity_check(value, THRESHOLD_RANGE[0], THRESHOLD_RANGE[1])
 
-        self.entry[channel].delete(0, Tkinter.END)
-        self.entry[channel].insert(0, '%.3f'%round(self.set_value[channel],3))
+        self.refreshEntry(channel)
 
     def setLockStatus(self, key):
-        # Check whether it is okay to lock, if yes then set a target which is halfway between current reading and threshold
-        if self.set_lock_status == 0:
-            if self.set_value[0] < self.display_apm:
-                self.set_lock_status = key
-                print "Set Lock"
-                self.lock_target = (self.set_value[0] + self.display_apm)/2
-                print "Lock target set at ", self.lock_target
-                self.label_lock_target['text'] = '%.1f'%round(self.lock_target,1)
-            else: 
-                print "Threshold too high, unable to lock"
-        elif self.set_lock_status == 1:
-            self.set_lock_status = key
-            print "Unset Lock"
-            self.lock_target = 0
-            self.label_lock_target['text'] = '%.3f'%round(self.lock_target,3)
-            # Change the value of the set voltage 6
-            for i in range(2):
-                self.set_value[i+5] = self.set_value[i+5] + self.display_offset_adj[i] 
-                self.entry[i+5].delete(0, Tkinter.END)
-                self.entry[i+5].insert(0, '%.3f'%round(self.set_value[i+5],3))
+        # The controller changes the lock status at the start of its next tick
+        self.controller.post(self.controller.setLockStatus, key)
+
+    def setOptimizer(self, name):
+        self.controller.post(self.controller.setOptimizer, name)
+
+    def refreshEntry(self, channel):
+        self.shown_set_value[channel] = self.controller.set_value[channel]
+        self.entry[channel].delete(0, Tkinter.END)
+        self.entry[channel].insert(0, '%.3f'%round(self.shown_set_value[channel],3))
 
     def updateLockProcess(self):
         # Check lock process and modify the correct display status
-        if self.lock_process == 0:
+        lock_process = self.controller.lock_process
+        if lock_process == 0:
             self.label_lock_process['text'] = 'No lock'
             self.label_lock_process['bg'] = 'white'
-        elif self.lock_process == 1:
+        elif lock_process == 1:
             self.label_lock_process['text'] = 'Processing'
             self.label_lock_process['bg'] = 'yellow'
-        elif self.lock_process == 2:
+        elif lock_process == 2:
             self.label_lock_process['text'] = 'Locked'
             self.label_lock_process['bg'] = 'green'
-        elif self.lock_process == 3:
+        elif lock_process == 3:
             self.label_lock_process['text'] = 'ERROR'
             self.label_lock_process['bg'] = 'red'
-        elif self.lock_process == 4:
+        elif lock_process == 4:
             self.label_lock_process['text'] = 'OUT OF LOCK'
             self.label_lock_process['bg'] = 'red'
 
-    def processIncoming(self):
-        """Handle all messages currently in the queue, if any."""
-        while self.queue.qsize(  ):
-            try:
-                msg = self.queue.get(0)
-                # Check contents of message and do whatever is needed. As a
-                # simple test, print it (in real life, you would
-                # suitably update the GUI's display in a richer fashion).
-                print msg
-            except Queue.Empty:
-                # just on general principles, although we don't
-                # expect this branch to be taken in this case
-                pass
+    def refresh(self):
+        """Copy the current state of the controller to the widgets."""
+        controller = self.controller
 
-class ThreadedClient:
+        # Set values can also be changed over zmq or by the lock
+        for i in range(7):
+            if controller.set_value[i] != self.shown_set_value[i]:
+                self.refreshEntry(i)
+
+        for i in range(1,7):
+            self.label_output[i]['text'] = 'Output : '+ '%.3f'%round(controller.output_value[i],3)
+        for i in range(2):
+            self.label_offset_adj[i]['text'] = '%.3f'%round(controller.display_offset_adj[i],3)
+
+        self.label_display_apm['text'] = '%.2f'%round(controller.display_apm,2)
+        self.label_lock_target['text'] = '%.1f'%round(controller.lock_target,1)
+        if controller.commands.empty():     # Don't undo a click the controller hasn't seen yet
+            self.set_lock.set(controller.set_lock_status)
+            self.optimizer_name.set(controller.optimizer_name)
+        self.updateLockProcess()
+
+        self.stats_countdown -= 1
+        if self.stats_countdown <= 0:
+            self.stats_countdown = 10
+            self.refreshStats()
+
+    def refreshStats(self):
+        stats = self.controller.statsSnapshot()
+        latency = stats['latency']
+        rates = stats['rates']
+        def p99(name):
+            return '%.1f' % (latency[name]['p99'] * 1000) if name in latency else '-'
+        self.label_stats['text'] = (
+            'p99 (ms)  tick ' + p99('tick') + '  jitter ' + p99('tick_jitter') + '  dac ' + p99('dac') +
+            '  counter ' + p99('counter_readline') + '  request ' + p99('request') + '\n' +
+            'per s  DAC writes %.1f  samples %.1f  requests %.1f' % (rates.get('dac_writes', 0), rates.get('samples', 0), rates.get('requests', 0)) +
+            '   exceptions %d  overruns %d' % (stats['counters'].get('swallowed_exceptions', 0), stats['scheduler'].get('overruns', 0)))
+
+class RetreatController:
     """
-    Launch the main part of the GUI and the worker thread. periodicCall and
-    endApplication could reside in the GUI part, but putting them here
-    means that you have all the thread controls in a single place.
+    The control loop, the devices and the zmq server, without any GUI. The
+    control loop runs on its own thread, so a slow redraw (or no display at
+    all) does not stall the voltage ramps or the locking. A GUI can observe
+    the controller through ThreadedClient.
     """
-    def __init__(self, master):
+    def __init__(self, acquisition=None, dac=None, clock=monotonic, sleep=time.sleep,
+                 server_address=SERVER_ADDRESS, telemetry_address=TELEMETRY_ADDRESS, log_path=None):
         """
-        Start the GUI and the asynchronous threads. We are in the main
-        (original) thread of the application, which will later be used by
-        the GUI as well. We spawn a new thread for the worker (I/O).
+        Initialise the state, the devices and the zmq server. Nothing runs
+        until start() is called.
+
+        By default the real counter and DAC are opened. A simulation (see
+        cavity_sim.py) passes its own acquisition and DAC, and a virtual
+        clock and sleep for the control loop. With a log_path, the samples,
+        the ticks and the lock transitions are logged there.
         """
-        self.master = master
+        self.acquisition = acquisition
+        self.dac = dac
+        self.clock = clock
+        # Latency histograms and counters of every stage and thread (see instrumentation.py)
+        self.stats = Stats(clock)
+        self.stats_cursor = 0       # Samples counted so far
+        # Commands from other threads (e.g. the GUI), executed at the start of the next tick
+        self.commands = Queue.Queue(  )
+
+        # Set values (0th item refers to set threshold) and output voltages
+        self.set_value = [0,0,0,0,0,0,0]
+        self.output_value = [0,0,0,0,0,0,0]
 
-        # Create the queue
-        self.queue = Queue.Queue(  )
+        # Step sizes of the GUI buttons and ShiftVolt (Channel 0th: set threshold, 1-6th: set voltage)
+        self.rough_step = [THRESHOLD_STEPS[0], 0.3, 0.3, 0.3, 0.3, 0.3, 0.3]
+        self.fine_step = [THRESHOLD_STEPS[1], 0.01, 0.01, 0.01, 0.01, 0.01, 0.01]
+        self.display_apm = 0
 
-        # Set up the GUI part
-        self.gui = GuiPart(master, self.queue, self.endApplication)
-        master.protocol("WM_DELETE_WINDOW", self.endApplication)   # About the silly exit button
+        # Lock Status
+        self.set_lock_status = 0
+        self.lock_target = 0
+        self.lock_process = 0 # 0: No lock, 1: Processing, 2: Locked, 3: ERROR, 4: Out of Lock  
+
+        # Voltage Offset adjustment for the lock (0th: Voltage 5, 1st: Voltage 6)
+        self.display_offset_adj = [0, 0]
+
+        # Set when the voltages are back to zero after endApplication
+        self.finished = threading.Event()
+
+        # Scheduler of the control loop
+        self.scheduler = PeriodicScheduler(TICK_PERIOD, self.periodicCall, clock=clock, sleep=sleep, stats=self.stats)
 
         # Start the procedure regarding the initialisation of experimental parameters and objects
         self.initialiseParameters()
 
-        # Initialising the zmq server
+        # Initialising the zmq server (many clients at once, see command_server.py)
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
-        self.socket.bind("tcp://127.0.0.1:5556")
+        self.command_lock = threading.Lock()    # Serialises the commands changing the state
+        self.structured_ops = {"set": self.opSet, "shift": self.opShift, "get": self.opGet,
+                               "lock_state": self.opLockState, "optimizer": self.opOptimizer, "stats": self.opStats,
+                               "text": self.opText}
+        self.server = CommandServer(self.context, server_address, self.handleMessage, SERVER_WORKERS, REQUEST_TIMEOUT,
+                                    stats=self.stats)
         print "The server is up. Ready to receive messages"
 
-        # Set up the thread to do asynchronous I/O
-        # More threads can also be created and used, if necessary
+        # Telemetry of every tick for dashboards and loggers (see telemetry_monitor.py)
+        # (XPUB rather than PUB, to hear about subscriptions and skip the work when nobody listens)
+        self.telemetry = self.context.socket(zmq.XPUB)
+        self.telemetry.bind(telemetry_address)
+        self.telemetry_topics = set()   # Topics with at least one subscriber (zmq reports the first and the last)
+
+        # Binary log of the run (see data_logger.py)
+        self.logger = None
+        if log_path:
+            self.logger = LogWriter(log_path, LOG_STREAMS, LOG_FLUSH_INTERVAL, clock=clock,
+                                    metadata={'tick_period': TICK_PERIOD, 'count_filter': COUNT_FILTER})
+            print "Logging to", log_path
+        self.log_cursor = 0         # Read position of the log in the ring buffers
+        self.log_raw_cursor = 0
+        self.logged_lock_state = None
+
+    def start(self):
+        # Set up the threads: acquisition, zmq server and the control loop itself
         self.running = 1
-        self.thread1 = threading.Thread(target=self.workerThread1_APM)
-        self.thread1.start(  )
-        self.thread2 = threading.Thread(target=self.workerThread2_zmq)
-        self.thread2.start(  )
+        self.acquisition.start(  )
+        self.server.start(  )
+        self.thread_control = threading.Thread(target=self.controlLoop)
+        self.thread_control.start(  )
 
-        # Start the periodic call in the GUI to check if the queue contains
-        # anything
-        self.periodicCall(  )
+    def post(self, func, *args):
+        """Ask the control thread to call func(*args) at the start of the next tick."""
+        self.commands.put((func, args))
+
+    def processIncoming(self):
+        """Handle all commands currently in the queue, if any."""
+        while self.commands.qsize(  ):
+            try:
+                func, args = self.commands.get(0)
+                func(*args)
+            except Queue.Empty:
+                # just on general principles, although we don't
+                # expect this branch to be taken in this case
+                pass
+
+    def setLockStatus(self, key):
+        # Check whether it is okay to lock, if yes then set a target which is halfway between current reading and threshold
+        if self.set_lock_status == 0:
+            if self.set_value[0] < self.display_apm:
+                self.set_lock_status = key
+                print "Set Lock"
+                self.lock_target = (self.set_value[0] + self.display_apm)/2
+                print "Lock target set at ", self.lock_target
+            else: 
+                print "Threshold too high, unable to lock"
+        elif self.set_lock_status == 1:
+            self.set_lock_status = key
+            print "Unset Lock"
+            self.lock_target = 0
+            # Change the value of the set voltage 5 and 6
+            for i in range(2):
+                self.set_value[i+5] = self.set_value[i+5] + self.display_offset_adj[i] 
 
     def initialiseParameters(self):
         # Communiate with the analog powermeter
         # self.apm = AnalogComm(analogpm_add)
         # self.APM_CHANNEL = 1
         
-        # # Communicate with the usb counter
-        self.counter = Countercomm(counter_add)
-        self.counter.set_gate_time(30)
+        # Back-to-back acquisition from the usb counter into a ring buffer (unless simulated)
+        if self.acquisition is None:
+            self.counter = Countercomm(counter_add)
+            self.counter.set_gate_time(GATE_TIME * 1000)
+            adaptive_gate = AdaptiveGate(**ADAPTIVE_GATE_PARAMS) if ADAPTIVE_GATE else None
+            self.acquisition = CountAcquisition(self.counter, COUNTER_CHANNELS, stats=self.stats, signal=LOCK_SIGNAL,
+                                                adaptive_gate=adaptive_gate, normalize_to=GATE_TIME)
+
+        # Read position of the telemetry in the ring buffer
+        self.sample_cursor = 0
         
-        # Create a variable to store the average value & number of averages of the analog powermeter
+        # Create a variable to store the filtered value of the counts, and the filter itself
         self.average_apm = 0
-        self.NUM_OF_AVG = 20 
+        self.count_filter = make_filter(COUNT_FILTER, **COUNT_FILTER_PARAMS)
+        print "Count filter", COUNT_FILTER, "with latency", self.count_filter.latency, "s"
+
+        if self.dac is None:
+            self.dac = USBDacProg(dac_add, usbdacprog)
+
+        # DACs that can play a whole ramp by themselves at a fine time step have a playback_step (s)
+        self.playback_step = getattr(self.dac, 'playback_step', None)
 
         # Creating the objects voltage_handler
         self.voltage_handler = [0,0,0,0,0,0,0]
         for i in range(1,7):
-            self.voltage_handler[i] = VoltageHandler(MAX_STEP_VOLTAGE[i], i)
+            self.voltage_handler[i] = VoltageHandler(MAX_SLEW_VOLTAGE[i] * TICK_PERIOD, i, RAMP_PROFILE,
+                                                     MAX_ACCEL_VOLTAGE[i], MAX_JERK_VOLTAGE[i], self.playback_step)
 
         # Initialise the variable set_voltage: These are the values that we want to set the DAC to.
         # Note: In voltage 6, it is the set_value (from GUI) + the fine adjustment for locking 
         self.set_voltage = [0,0,0,0,0,0,0]
 
-        # Initialise the offset adj voltage & correction direction 
+        # Initialise the offset adj voltage
         self.offset_adj_voltage = [0, 0]
-        self.offset_adj_direction = 1 #1 for positive, -1 for negative direction
-        self.count_adj_steps = 0
 
         # Lock request variable (1: asking for lock, 0: nothing)
         self.lock_request = 0
 
-        # Create the locking delay variable & locking mode
-        self.LOCKING_DELAY = 5
+        # Create the locking delay variable
+        # The delay (in ticks) waits for the filter to catch up with a correction
+        self.LOCKING_DELAY = max(1, int(math.ceil(self.count_filter.latency / TICK_PERIOD)))
         self.lock_delay_counter = 0
-        self.locking_mode = 1   # Starts locking from voltage 6
-        self.locking_mode_max = self.locking_mode + MAX_LOCKING_TRIES
 
-    def periodicCall(self):
+        # The lock optimizer, and how the last lock went
+        self.last_lock_process = 0
+        self.lock_start_time = 0
+        self.time_to_lock = None
+        self.setOptimizer(LOCK_OPTIMIZER)
+
+    def setOptimizer(self, name):
+        """
+        Select the lock optimizer. A search in progress restarts with the new
+        one. To be called from the control thread (use post).
         """
-        Check every 100 ms if there is something new in the queue.
+        evaluation_time = self.LOCKING_DELAY * TICK_PERIOD  # One optimizer step per LOCKING_DELAY
+        kwargs = {}
+        if name == 'hillclimb':
+            kwargs['axis_evaluations'] = [max(1, int(round(t / evaluation_time))) for t in MAX_LOCKING_TIME]
+            kwargs['tries'] = MAX_LOCKING_TRIES
+        self.optimizer = make_optimizer(name, STEP_OFFSET_ADJ, int(LOCK_TIME_BUDGET / evaluation_time),
+                                        bounds=(MIN_OFFSET_ADJ, MAX_OFFSET_ADJ), **kwargs)
+        self.optimizer_name = name
+        print "Lock optimizer set to", name
+        if self.lock_process == 1:
+            self.startLockSearch()
+
+    def startLockSearch(self):
+        # Start the optimizer from the current offsets
+        self.offset_adj_voltage[:] = self.optimizer.reset(self.offset_adj_voltage)
+        self.lock_delay_counter = 0
+        self.lock_start_time = self.clock()
+        self.time_to_lock = None
+
+    def requestLock(self):
+        # "Please Lock", on the control thread: (re)start the search, unless the lock is not set
+        if self.set_lock_status == 0:
+            self.lock_request = 0
+            return
+        self.lock_request = 1
+        if self.lock_process == 3:
+            print "Trying to lock again"
+            self.lock_process = 1
+        if self.lock_process == 1:
+            # Asked to lock while already locking (or again after failing): start over
+            self.startLockSearch()
+
+    def clearLockRequest(self):
+        # The requester has been told the lock succeeded
+        self.lock_request = 0
+
+    def controlLoop(self):
         """
-        self.gui.processIncoming(  )
+        Runs periodicCall every TICK_PERIOD on the control thread until the
+        shutdown is complete. The scheduler keeps the ticks on a monotonic
+        grid, records their jitter and overruns, and keeps ticking after a
+        tick that raised (counted as swallowed_exceptions).
+        """
+        self.scheduler.run(self.finished.is_set)
 
-        # Setting a refresh rate for periodic call
-        self.master.after(100, self.periodicCall)
+    def periodicCall(self):
+        """
+        One tick of the control loop: handle the queued commands, filter the
+        counts, run the lock and step the voltages. Every stage is timed
+        into the stats.
+        """
+        t = monotonic()
+        self.processIncoming(  )
+        t = self.lap('commands', t)
+        self.processSamples()
+        t = self.lap('filter', t)
         
         # Check the lock status and perform locking/unlocking if necessary
-        if self.gui.set_lock_status == 0:
-            self.gui.lock_process = 0
+        if self.set_lock_status == 0:
+            self.lock_process = 0
             self.offset_adj_voltage[0] = 0
             self.offset_adj_voltage[1] = 0
-        elif self.gui.set_lock_status == 1 and self.lock_request == 0:
-            if self.average_apm < self.gui.set_value[0]:
-                self.gui.lock_process = 4
-        elif self.gui.set_lock_status == 1 and self.lock_request == 1:
+        elif self.set_lock_status == 1 and self.lock_request == 0:
+            if self.average_apm < self.set_value[0]:
+                self.lock_process = 4
+        elif self.set_lock_status == 1 and self.lock_request == 1:
             # Check for whether display APM is in locked condition
-            if self.gui.lock_process == 4:
-                self.gui.lock_process = 1
-            if self.average_apm > self.gui.lock_target:
-                self.gui.lock_process = 2
-
-        # Simple slow locking mechanism. Note: the value of display_apm in GUI is delayed by 100ms from average_apm
-        if self.gui.lock_process == 1:
+            if self.lock_process == 4:
+                self.lock_process = 1
+            if self.average_apm > self.lock_target:
+                self.lock_process = 2
+
+        # Slow locking mechanism: a new search starts whenever the lock process (re)starts
+        if self.lock_process == 1 and self.last_lock_process != 1:
+            self.startLockSearch()
+        if self.lock_process == 1:
             self.lock_delay_counter +=1
-            self.try_mode = self.locking_mode % 2          
             if self.lock_delay_counter >= self.LOCKING_DELAY: #Delay for the correction to set in
-                if self.average_apm < self.gui.display_apm:
-                    self.offset_adj_direction = -1 * self.offset_adj_direction      # Reverse the process if the correction does not become better
-                self.offset_adj_voltage[self.try_mode] += STEP_OFFSET_ADJ * self.offset_adj_direction
                 self.lock_delay_counter = 0
-            self.count_adj_steps += 1
-            if self.count_adj_steps >= MAX_LOCKING_STEP[self.try_mode]:
-                self.locking_mode +=1
-                self.count_adj_steps = 0
-                print "Trying locking in other direction"
-        if self.locking_mode >= self.locking_mode_max:
-            self.gui.lock_process = 3 
-
-        # Update the display status of the lock
-        self.gui.updateLockProcess()
+                offsets = self.optimizer.step(self.offset_adj_voltage, self.average_apm)
+                if offsets is None:
+                    print "Lock optimizer", self.optimizer_name, "gave up after", self.optimizer.iterations, "iterations"
+                    self.lock_process = 3
+                else:
+                    self.offset_adj_voltage[:] = offsets
+        if self.lock_process == 2 and self.last_lock_process == 1:
+            self.time_to_lock = self.clock() - self.lock_start_time
+            print "Locked by", self.optimizer_name, "after", self.optimizer.iterations, "iterations in", '%.1f'%self.time_to_lock, "s"
+        self.last_lock_process = self.lock_process
+        t = self.lap('lock', t)
 
         # Check the insanity of the offset adj voltage and refresh periodically the offset_adj_voltage display
         for i in range(2):
             self.offset_adj_voltage[i] = insanity_check(self.offset_adj_voltage[i], MIN_OFFSET_ADJ, MAX_OFFSET_ADJ)
-            self.gui.display_offset_adj[i] = self.offset_adj_voltage[i]
-            self.gui.label_offset_adj[i]['text'] = '%.3f'%round(self.gui.display_offset_adj[i],3)
+            self.display_offset_adj[i] = self.offset_adj_voltage[i]
 
         # Updating the set voltage based on the gui set value. For voltage 5 and 6, need to add the offset adj.
         for i in range(1,5):
-            self.set_voltage[i] = self.gui.set_value[i]
+            self.set_voltage[i] = self.set_value[i]
         for i in range(2):
-            self.set_voltage[i+5] = self.gui.set_value[i+5] + self.offset_adj_voltage[i]
+            self.set_voltage[i+5] = self.set_value[i+5] + self.offset_adj_voltage[i]
 
         # Voltage "insanity check" for the final time before being processed by the program
         for i in range(1,7):
             self.set_voltage[i] = insanity_check(self.set_voltage[i], MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
         
-        # Updating the voltage handler objects & GUI
+        # Updating the voltage handler objects
         for i in range(1,7):
             self.voltage_handler[i].change_set_voltage(self.set_voltage[i])
-            output = self.voltage_handler[i].update()
-            self.gui.output_value[i] = output
-            self.gui.label_output[i]['text'] = 'Output : '+ '%.3f'%round(self.gui.output_value[i],3)
+            output = self.voltage_handler[i].update(self.clock())
+            self.output_value[i] = output
+        t = self.lap('ramps', t)
+
+        # Commit all the channels that moved to the DAC as a single frame
+        self.commitFrame()
+        t = self.lap('dac', t)
 
         # Updating the display value of analog powermeter
-        self.gui.display_apm = self.average_apm
-        self.gui.label_display_apm['text'] = '%.2f'%round(self.gui.display_apm,2)
+        self.display_apm = self.average_apm
+
+        # Tell the subscribers what happened in this tick
+        self.publishTelemetry()
+        t = self.lap('telemetry', t)
+        if self.logger:
+            self.logTick()
+            t = self.lap('log', t)
+        self.stats.sample()
 
         # Shutting down the program
         if not self.running:
             # Check whether the voltages has been switched off
             for i in range(1,7):
-                if self.gui.output_value[i] == 0:
+                if self.output_value[i] == 0:
                     pass
                 else:
                     return 0
             print "Shutting Down"
-            import sys
-            sys.exit()
-
-
-    def workerThread1_APM(self):
+            try:
+                self.acquisition.stop()
+                self.server.stop()
+                self.telemetry.close(linger=0)
+                self.dac.close()
+                if self.logger:
+                    self.logger.close()
+            finally:
+                # Even if some of it failed, there is nothing left to tick for
+                self.finished.set()
+
+
+    def publishTelemetry(self):
         """
-        This is where we handle the asynchronous I/O. For example, it may be
-        a 'select(  )'. One important thing to remember is that the thread has
-        to yield control pretty regularly, by select or otherwise.
+        Broadcast the state of this tick on the XPUB socket, as the topic
+        "telemetry" followed by a JSON object. Never blocks: if a subscriber
+        can't keep up, zmq drops its messages.
         """
-        while self.running:
-            # To simulate asynchronous I/O, we create a random number at
-            # random intervals. Replace the following two lines with the real
-            # thing.
-            try:
-                # Analog Powermeter
-                # now = float(self.apm.get_voltage(self.APM_CHANNEL))
-                # Usb Counter
-                now = float(self.counter.get_counts(0))
-            
-                self.average_apm = (self.NUM_OF_AVG-1)*self.average_apm/self.NUM_OF_AVG + now/self.NUM_OF_AVG
-            except:
-                pass
-    
-    def workerThread2_zmq(self):
+        # Subscription messages: first byte 1 for the first subscriber of a topic, 0 for its last
+        # unsubscribe, then the topic (a prefix; "" for everything)
+        while self.telemetry.poll(0):
+            message = self.telemetry.recv()
+            if message[:1] == b'\x01':
+                self.telemetry_topics.add(message[1:])
+            else:
+                self.telemetry_topics.discard(message[1:])
+        if not [topic for topic in self.telemetry_topics if b'telemetry'.startswith(topic)]:
+            self.sample_cursor = self.acquisition.buffer.count
+            return
+
+        timestamps, counts, self.sample_cursor = self.acquisition.buffer.since(self.sample_cursor)
+        last_tick = self.scheduler.history.last()
+        telemetry = {"time": self.clock(), "tick": self.scheduler.ticks,
+                     "counts": self.average_apm,
+                     "samples": {"time": timestamps.tolist(), "counts": counts.tolist()},
+                     "output": self.output_value[1:7], "set": self.set_value[1:7],
+                     "offset_adj": list(self.offset_adj_voltage),
+                     "set_lock_status": self.set_lock_status, "lock_process": self.lock_process,
+                     "lock_target": self.lock_target,
+                     "optimizer": self.optimizer_name, "iterations": self.optimizer.iterations,
+                     "timing": {"jitter": float(last_tick[1][0]) if last_tick else 0.,
+                                "duration": float(last_tick[1][1]) if last_tick else 0.,
+                                "overruns": self.scheduler.overruns, "skipped": self.scheduler.skipped}}
+        self.telemetry.send_multipart(["telemetry", json.dumps(telemetry)])
+
+    def lap(self, stage, start):
+        # Record the time since start for a stage of the tick, and return the time now
+        now = monotonic()
+        self.stats.record(stage, now - start)
+        return now
+
+    def statsSnapshot(self):
+        # Everything the stats and the scheduler know, for Check Stats and the GUI
+        snapshot = self.stats.snapshot()
+        snapshot['scheduler'] = self.scheduler.stats()
+        return snapshot
+
+    def logTick(self):
+        # The new samples, the state of this tick, and the lock state if it changed
+        timestamps, counts, self.log_cursor = self.acquisition.buffer.since(self.log_cursor)
+        self.logger.extend('samples', [timestamps, counts])
+        raw = getattr(self.acquisition, 'raw', None)
+        if raw is not None:
+            timestamps, counts, self.log_raw_cursor = raw.since(self.log_raw_cursor)
+            self.logger.extend('channels', [timestamps, counts])
+        now = self.clock()
+        self.logger.append('ticks', (now, self.average_apm, self.set_voltage[1:7], self.output_value[1:7],
+                                     self.offset_adj_voltage, self.lock_process, self.set_lock_status))
+        lock_state = (self.lock_process, self.set_lock_status, self.lock_request)
+        if lock_state != self.logged_lock_state:
+            self.logger.append('lock', (now,) + lock_state)
+            self.logged_lock_state = lock_state
+
+    def commitFrame(self):
+        # Single steps go out as one frame, new ramps are handed to the DAC in one playback
+        frame = []
+        ramps = []
+        for i in range(1,7):
+            if self.voltage_handler[i].pending:
+                frame.append((i-1, self.voltage_handler[i].output_voltage))
+                self.voltage_handler[i].pending = False
+            if self.voltage_handler[i].upload:
+                ramps.append((i-1, self.voltage_handler[i].trajectory))
+                self.voltage_handler[i].upload = False
+        if frame:
+            self.dac.set_voltages(frame)
+            self.stats.count('dac_writes')
+        if ramps:
+            self.dac.play(ramps, self.playback_step)
+            self.stats.count('dac_writes')
+
+    def processSamples(self):
+        """
+        Run the count filter over the samples that arrived since the last
+        call. The samples come from the acquisition thread through its ring
+        buffer, so nothing here blocks on the serial port.
         """
-        This is where we handle the asynchronous I/O. For example, it may be
-        a 'select(  )'. One important thing to remember is that the thread has
-        to yield control pretty regularly, by select or otherwise.
+        # Analog Powermeter (no pipelined acquisition for it yet)
+        # now = float(self.apm.get_voltage(self.APM_CHANNEL))
+        self.average_apm = self.count_filter.update(self.acquisition.buffer)
+        count = self.acquisition.buffer.count
+        self.stats.count('samples', count - self.stats_cursor)
+        self.stats_cursor = count
+
+    def handleStructured(self, message):
         """
-        while self.running:
+        Handle a JSON request carrying a list of operations, e.g.
+            {"ops": [{"op": "set", "channel": 1, "value": 0.5},
+                     {"op": "get"}, {"op": "lock_state"}]}
+        and reply with {"results": [...]}, one result per operation in the
+        same order. A failing operation gives {"error": ...} in its slot and
+        does not stop the others. A request that is not a list of objects
+        is refused as a whole, before anything runs.
+        """
+        try:
+            ops = json.loads(message)["ops"]
+        except (ValueError, KeyError, TypeError):
+            return json.dumps({"error": "Speak Properly"})
+        if not isinstance(ops, list) or not all([isinstance(op, dict) for op in ops]):
+            return json.dumps({"error": "Speak Properly"})
+        results = []
+        for op in ops:
             try:
-                self.message = self.socket.recv()
-                print "Received message from the other side :", self.message      
-
-                try:
-                    self.message_a, self.message_b = self.message.split(" ")
-                except:
-                    print "MESSAGE ILL DEFINED"
-                    # Tell Boss the message is ill defined
-                    self.socket.send("Speak Properly")
-
-                # The reply if it does not satisfy anything below
-                self.message_back = "Whatdahell Boss"
-
-                try:
-                # A big try
-
-                    if self.message_a == "Please":
-                        # Dealing with lock
-                        if self.message_b == "Lock":
-                            self.lock_request = 1
-                            self.locking_mode = 1   # Start locking from V6 again
-                            self.count_adj_steps = 0
-                            self.message_back = "Okay Boss"
-                            if self.gui.lock_process == 3:
-                                print "Trying to lock again"
-                                self.gui.lock_process = 1
-                            # Check whether the lock is set
-                            if self.gui.set_lock_status == 0:
-                                print "Lock is not set. Tell the other side"
-                                self.message_back ="Lock Nonexistent"
-                                self.lock_request = 0
-                        # Dealing with shutdown
-                        if self.message_b == "Annihilate":
-                            self.message_back = "Okay Boss"
-                            self.endApplication()
-
-                    if self.message_a == "Check":
-                        if self.message_b == "Lock":
-                            # ----- DEALING WITH LOCK ----- #
-                            # Check if the lock is obtained (or error)
-                            if self.gui.lock_process == 2:
-                                print "Locked successful, tell the good news to the other side"
-                                self.message_back = "Lock Successful"
-                                self.lock_request = 0
-                            elif self.gui.lock_process == 3:
-                                print "Locked not successful, tell the bad news to the other side"
-                                self.message_back = "Lock Unsuccessful"
-                            # Misc
-                            elif self.gui.lock_process == 1:
-                                print "Still Locking"
-                                self.message_back = "Still Locking"
-                            else:
-                                print "Request for check lock is probably not at the correct moment"
-                                self.message_back = "Something Wrong"
-                            # ----- END ----- #
-
-                    if self.message_a == "CheckVolt":
-                        # Check voltage for a specific channel
-                        channel = int(float(self.message_b))
-                        if channel > 0 and channel < 7:
-                            value = '%.3f'%round(self.gui.output_value[channel],3)
-                            self.message_back = "Volt" + str(channel) + " " + value
-                        else:
-                            self.message_back = "Volt" + str(channel) + " " + "Undefined"
-
-                    if self.message_a[:-1] == "SetVolt":
-                        channel = int(self.message_a[-1])
-                        if channel > 0 and channel < 7:
-                            value = round(float(self.message_b),3)
-                            value = insanity_check(value, MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
-                            self.gui.set_value[channel] = value
-                            self.message_back = "SetVolt" + str(channel) + " " + str(value)
-                        else:
-                            self.message_back = "SetVolt" + str(channel) + " " + "Undefined"                
-                
-                    if self.message_a[:-1] == "ShiftVolt":
-                        channel = int(self.message_a[-1])
-                        if channel > 0 and channel < 7:
-                            if self.message_b == "Up":
-                                self.gui.set_value[channel] += self.gui.fine_step[channel]
-                                self.message_back = "ShiftVolt" + str(channel) + " " + "Up"
-                            if self.message_b == "Down":
-                                self.gui.set_value[channel] -= self.gui.fine_step[channel]
-                                self.message_back = "ShiftVolt" + str(channel) + " " + "Down"
-                        else:
-                            self.message_back = "ShiftVolt" + str(channel) + " " + "Undefined"    
-
-                except:
-                # The message is ill defined
-                    self.message_back = "Speak Properly"
-
-                # Finally send the message back
-                self.socket.send(self.message_back)
-
-            except:
-                pass
-
-
+                results.append(self.structured_ops[op["op"]](op))
+            except Exception as e:
+                results.append({"error": "%s: %s" % (e.__class__.__name__, e)})
+        return json.dumps({"results": results})
+
+    def _channel(self, op):
+        channel = int(op["channel"])
+        if channel < 1 or channel > 6:
+            raise IndexError("channel %d undefined" % channel)
+        return channel
+
+    def opSet(self, op):
+        # Set voltage of one channel
+        channel = self._channel(op)
+        value = insanity_check(round(float(op["value"]),3), MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
+        with self.command_lock:
+            self.set_value[channel] = value
+        return {"channel": channel, "set": value}
+
+    def opShift(self, op):
+        # Shift the voltage of one channel by the fine step, "up" or "down"
+        channel = self._channel(op)
+        sign = {"up": 1, "down": -1}[op["direction"].lower()]
+        with self.command_lock:
+            self.set_value[channel] = insanity_check(self.set_value[channel] + sign*self.fine_step[channel], MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
+            value = self.set_value[channel]
+        return {"channel": channel, "set": value}
+
+    def opGet(self, op):
+        # Output voltage of one channel, or of all of them if no channel is given
+        if "channel" in op:
+            channel = self._channel(op)
+            return {"channel": channel, "output": self.output_value[channel], "set": self.set_value[channel]}
+        return {"output": self.output_value[1:7], "set": self.set_value[1:7]}
+
+    def opLockState(self, op):
+        return {"set_lock_status": self.set_lock_status, "lock_process": self.lock_process,
+                "lock_request": self.lock_request, "lock_target": self.lock_target,
+                "threshold": self.set_value[0], "counts": self.average_apm,
+                "offset_adj": list(self.offset_adj_voltage),
+                "optimizer": self.optimizer_name, "iterations": self.optimizer.iterations,
+                "time_to_lock": self.time_to_lock}
+
+    def opOptimizer(self, op):
+        # Select the lock optimizer if a name is given, and report on it
+        if "name" in op:
+            if op["name"] not in OPTIMIZERS:
+                raise KeyError(op["name"])
+            self.post(self.setOptimizer, op["name"])
+            return {"optimizer": op["name"]}
+        return {"optimizer": self.optimizer_name, "iterations": self.optimizer.iterations,
+                "time_to_lock": self.time_to_lock, "available": sorted(OPTIMIZERS)}
+
+    def opStats(self, op):
+        # Latency histograms, counters and their rates
+        return self.statsSnapshot()
+
+    def opText(self, op):
+        # Any command of the two-word text protocol, e.g. "Please Lock"
+        return {"reply": self.handleMessage(str(op["command"]))}
+
+    def handleMessage(self, message):
+        """
+        Handle one message of the two-word text protocol (see
+        lock_requester.py), or a structured JSON request, and return the
+        reply. Called from the worker
+        threads of the command server, so several can run at once; the
+        commands changing the lock state take the command lock.
+        """
+        print "Received message from the other side :", message      
+
+        # Structured (JSON) requests
+        if message.startswith("{"):
+            return self.handleStructured(message)
+
+        try:
+            message_a, message_b = message.split(" ")
+        except ValueError:
+            print "MESSAGE ILL DEFINED"
+            # Tell Boss the message is ill defined
+            return "Speak Properly"
+
+        # The reply if it does not satisfy anything below
+        message_back = "Whatdahell Boss"
+
+        try:
+        # A big try
+
+            if message_a == "Please":
+                with self.command_lock:
+                    # Dealing with lock: the lock state belongs to the control thread, which takes the request at its next tick
+                    if message_b == "Lock":
+                        self.post(self.requestLock)
+                        message_back = "Okay Boss"
+                        # Check whether the lock is set
+                        if self.set_lock_status == 0:
+                            print "Lock is not set. Tell the other side"
+                            message_back ="Lock Nonexistent"
+                    # Dealing with shutdown
+                    if message_b == "Annihilate":
+                        message_back = "Okay Boss"
+                        self.endApplication()
+
+            if message_a == "Check":
+                if message_b == "Lock":
+                    # ----- DEALING WITH LOCK ----- #
+                    # Check if the lock is obtained (or error)
+                    if self.lock_process == 2:
+                        print "Locked successful, tell the good news to the other side"
+                        message_back = "Lock Successful"
+                        self.post(self.clearLockRequest)
+                    elif self.lock_process == 3:
+                        print "Locked not successful, tell the bad news to the other side"
+                        message_back = "Lock Unsuccessful"
+                    # Misc
+                    elif self.lock_process == 1:
+                        print "Still Locking"
+                        message_back = "Still Locking"
+                    else:
+                        print "Request for check lock is probably not at the correct moment"
+                        message_back = "Something Wrong"
+                    # ----- END ----- #
+                if message_b == "Optimizer":
+                    # Optimizer, iterations of the last search and its time to lock (None if not locked)
+                    time_to_lock = 'None' if self.time_to_lock is None else '%.1f'%self.time_to_lock
+                    message_back = "Optimizer " + self.optimizer_name + " " + str(self.optimizer.iterations) + " " + time_to_lock
+                if message_b == "Stats":
+                    # Latency histograms and counters, as a JSON object
+                    message_back = json.dumps(self.statsSnapshot())
+
+            if message_a == "SetOptimizer":
+                if message_b in OPTIMIZERS:
+                    self.post(self.setOptimizer, message_b)
+                    message_back = "SetOptimizer " + message_b
+                else:
+                    message_back = "SetOptimizer Undefined"
+
+            if message_a == "CheckVolt":
+                # Check voltage for a specific channel
+                channel = int(float(message_b))
+                if channel > 0 and channel < 7:
+                    value = '%.3f'%round(self.output_value[channel],3)
+                    message_back = "Volt" + str(channel) + " " + value
+                else:
+                    message_back = "Volt" + str(channel) + " " + "Undefined"
+
+            if message_a[:-1] == "SetVolt":
+                with self.command_lock:
+                    channel = int(message_a[-1])
+                    if channel > 0 and channel < 7:
+                        value = round(float(message_b),3)
+                        value = insanity_check(value, MIN_VALUE_VOLTAGE, MAX_VALUE_VOLTAGE)
+                        self.set_value[channel] = value
+                        message_back = "SetVolt" + str(channel) + " " + str(value)
+                    else:
+                        message_back = "SetVolt" + str(channel) + " " + "Undefined"                
+        
+            if message_a[:-1] == "ShiftVolt":
+                with self.command_lock:
+                    channel = int(message_a[-1])
+                    if channel > 0 and channel < 7:
+                        if message_b == "Up":
+                            self.set_value[channel] += self.fine_step[channel]
+                            message_back = "ShiftVolt" + str(channel) + " " + "Up"
+                        if message_b == "Down":
+                            self.set_value[channel] -= self.fine_step[channel]
+                            message_back = "ShiftVolt" + str(channel) + " " + "Down"
+                    else:
+                        message_back = "ShiftVolt" + str(channel) + " " + "Undefined"    
+
+        except:
+        # The message is ill defined
+            self.stats.count('swallowed_exceptions')
+            message_back = "Speak Properly"
+
+        return message_back
 
     def endApplication(self):
-        # Cleaning up before shutting down
+        # Cleaning up before shutting down (dropping the lock also brings the V5/V6 offsets back to zero)
+        self.set_lock_status = 0
         for i in range(1,7):
-            self.gui.set_value[i] = 0
+            self.set_value[i] = 0
 
         # Kill and wait for the processes to be killed
         self.running = 0
@@ -502,11 +912,47 @@ class ThreadedClient:
         # print "Analog powermeter has turned off."
 
 
+class ThreadedClient:
+    """
+    Launch the GUI on top of a running RetreatController. The GUI is only an
+    observer: periodicCall refreshes the widgets every 100 ms, and a slow
+    redraw or a dragged window no longer delays the control loop.
+    """
+    def __init__(self, master, controller):
+        self.master = master
+        self.controller = controller
+
+        # Set up the GUI part
+        self.gui = GuiPart(master, controller, controller.endApplication)
+        master.protocol("WM_DELETE_WINDOW", controller.endApplication)   # About the silly exit button
+
+        # Start the periodic refresh of the GUI
+        self.periodicCall(  )
+
+    def periodicCall(self):
+        """
+        Refresh the GUI every 100 ms, until the controller has shut down.
+        """
+        self.gui.refresh(  )
+        if self.controller.finished.is_set():
+            print "Closing the GUI"
+            self.master.destroy(  )
+            return
+        self.master.after(100, self.periodicCall)
+
 class VoltageHandler:
     """
-    Handles the set voltage and give appropriate commands 
+    Handles the set voltage and give appropriate commands. Every change of
+    the set voltage plans the whole ramp to it (see trajectory.py), from
+    wherever the output is at the time.
+
+    Without playback_step, update() steps the output to the next point of
+    the ramp every tick and the owner of the DAC commits the writes of all
+    channels together (see RetreatController.commitFrame). With it, the
+    ramp is planned at that finer step and uploaded to the DAC once
+    (upload), and update() only follows where the DAC has got to.
     """
-    def __init__(self, arg_max_step, arg_channel):
+    def __init__(self, arg_max_step, arg_channel, profile='linear', max_acceleration=None, max_jerk=None, playback_step=None):
         """
         Initialise the object and giving it initial value
         """
@@ -514,33 +960,82 @@ class VoltageHandler:
         self.output_voltage = 0
         self.max_step = arg_max_step
         self.channel = arg_channel
+        self.profile = profile
+        self.max_acceleration = max_acceleration
+        self.max_jerk = max_jerk
+        self.playback_step = playback_step
+        self.pending = False    # Output moved but not yet written to the DAC
+        self.upload = False     # New ramp not yet handed to the DAC
+        self.target = 0         # End of the current ramp
+        self.trajectory = None  # Points of the current ramp
+        self.played = False     # The current ramp is played by the DAC
         print "Created Object Voltage Handler No. ", self.channel
 
     def change_set_voltage(self, arg_set_voltage):
         self.set_voltage = arg_set_voltage
 
-    def update(self):
-        if self.output_voltage != self.set_voltage:
-            if self.output_voltage > self.set_voltage:
-                step_down = min((self.output_voltage-self.set_voltage), self.max_step)
-                self.output_voltage -= step_down
-            elif self.output_voltage < self.set_voltage:
-                step_up = min((self.set_voltage-self.output_voltage), self.max_step)
-                self.output_voltage += step_up
-            ''' Here is where the command line to change the voltage goes '''
-            print "Output Voltage ", self.channel, " set to ", self.output_voltage
-            sp.call([usbdacprog + " -d " + dac_add + " " + str(self.channel-1) + " " + '%.3f'%round(self.output_voltage,3)], shell=True)
+    def plan(self, now):
+        if self.playback_step:
+            dt = self.playback_step
+        else:
+            dt = TICK_PERIOD
+        if abs(self.set_voltage - self.output_voltage) <= self.max_step:
+            # Within one tick of slew (e.g. the corrections of the lock): a single step, as always
+            self.trajectory = [self.set_voltage]
+        else:
+            self.trajectory = plan_trajectory(self.profile, self.output_voltage, self.set_voltage, self.max_step / TICK_PERIOD,
+                                              dt, self.max_acceleration, self.max_jerk)
+        self.target = self.set_voltage
+        self.trajectory_start = now
+        self.next_point = 0
+        # A single step is just written, anything longer is played by the DAC if it can
+        self.played = bool(self.playback_step) and len(self.trajectory) > 1
+        self.upload = self.played
+
+    def update(self, now):
+        if self.set_voltage != self.target:
+            self.plan(now)
+        if self.trajectory is not None and len(self.trajectory):
+            if self.played:
+                # The point the DAC has reached by now
+                point = int((now - self.trajectory_start) / self.playback_step + 1e-6) - 1
+            else:
+                point = self.next_point
+                self.next_point += 1
+            if point >= 0:
+                self.output_voltage = float(self.trajectory[min(point, len(self.trajectory) - 1)])
+                if not self.played:
+                    self.pending = True
+            if point >= len(self.trajectory) - 1:
+                self.trajectory = None
         # Return output_voltage to be displayed on the GUI
         return self.output_voltage
 
 ''' Main program goes here '''
 
-rand = random.Random(  )
-root = Tkinter.Tk(  )
-root.title("Cavity Retreat Version 1.03")
-
-img = Tkinter.PhotoImage(file='icon.png')
-root.tk.call('wm', 'iconphoto', root._w, img)
-
-client = ThreadedClient(root)
-root.mainloop(  )
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cavity retreat controller')
+    parser.add_argument('--headless', action='store_true', help='run without the GUI, e.g. as a service on a machine without display')
+    parser.add_argument('--log', default=time.strftime(LOG_PATH_FORMAT), help='data log file, must not exist yet (default: %(default)s)')
+    parser.add_argument('--no-log', action='store_true', help="don't log the run")
+    args = parser.parse_args()
+
+    controller = RetreatController(log_path=None if args.no_log else args.log)
+    controller.start()
+
+    if args.headless:
+        # Shut down (ramping the voltages to zero) on Ctrl-C or a kill from the service manager
+        signal.signal(signal.SIGINT, lambda signum, frame: controller.endApplication())
+        signal.signal(signal.SIGTERM, lambda signum, frame: controller.endApplication())
+        # Wait with a timeout, otherwise the signals are never delivered
+        while not controller.finished.wait(1):
+            pass
+    else:
+        root = Tkinter.Tk(  )
+        root.title("Cavity Retreat Version 1.03")
+
+        img = Tkinter.PhotoImage(file='icon.png')
+        root.tk.call('wm', 'iconphoto', root._w, img)
+
+        client = ThreadedClient(root, controller)
+        root.mainloop(  )
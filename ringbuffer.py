@@ -0,0 +1,108 @@
+'''
+Preallocated, timestamped ring buffer for acquired samples
+Aug 2016
+
+One thread writes (the acquisition), any number of threads read (control
+loop, zmq server, GUI) without taking a lock. Before writing, the writer
+bumps reserved (the count once the write is done), then fills the slots,
+and only then bumps the sample count, so readers never see a half-written
+sample. Readers copy at most the samples the writer has reserved no slot
+over, and check reserved again after copying to make sure the writer has
+not lapped them in the meantime (a single push or a whole extend).
+
+With mirror=True every sample is written twice, size slots apart, so the
+last n (< size) samples are always contiguous and window() returns them
+as views instead of copies (for fast streams read in bulk).
+'''
+
+import numpy as np
+
+
+class RingBuffer(object):
+
+    def __init__(self, size, width=1, dtype=np.float64, mirror=False):
+        self.size = size
+        self.width = width
+        self.mirror = mirror
+        slots = 2 * size if mirror else size
+        self.time = np.zeros(slots, dtype=np.float64)
+        if width == 1:
+            self.data = np.zeros(slots, dtype=dtype)
+        else:
+            self.data = np.zeros((slots, width), dtype=dtype)
+        self.count = 0      # Total number of samples ever written
+        self.reserved = 0   # count once the write in progress is done
+
+    def push(self, timestamp, value):
+        ''' Only to be called from the single writer thread '''
+        i = self.count % self.size
+        self.reserved = self.count + 1
+        self.time[i] = timestamp
+        self.data[i] = value
+        if self.mirror:
+            self.time[i + self.size] = timestamp
+            self.data[i + self.size] = value
+        self.count += 1
+
+    def extend(self, timestamps, values):
+        ''' Push many samples at once (arrays, oldest first), same rules as push '''
+        n = len(timestamps)
+        first = self.count
+        if n > self.size:
+            first += n - self.size          # Only the last size samples would survive anyway
+            timestamps, values = timestamps[-self.size:], values[-self.size:]
+        self.reserved = self.count + n
+        index = (first + np.arange(len(timestamps))) % self.size
+        self.time[index] = timestamps
+        self.data[index] = values
+        if self.mirror:
+            self.time[index + self.size] = timestamps
+            self.data[index + self.size] = values
+        self.count += n
+
+    def _copy(self, start, stop):
+        # Copy samples with absolute index [start, stop) out of the buffer
+        i = start % self.size
+        if i + stop - start <= self.size:
+            return self.time[i:i + stop - start].copy(), self.data[i:i + stop - start].copy()
+        idx = np.arange(start, stop) % self.size
+        return self.time[idx], self.data[idx]
+
+    def since(self, cursor):
+        '''
+        Return (timestamps, values, new_cursor) for all samples written after
+        the absolute index cursor. If the writer has overwritten some of them,
+        only the ones still in the buffer are returned. The slots the writer
+        fills next (reserved) are never read, so at most size - 1 samples
+        come back while it is writing.
+        '''
+        while True:
+            stop = self.count
+            start = min(max(cursor, self.reserved - self.size, 0), stop)
+            t, v = self._copy(start, stop)
+            # The writer may have lapped the oldest samples we copied (or be filling them) in the meantime
+            if self.reserved - self.size <= start:
+                return t, v, stop
+
+    def latest(self, n):
+        ''' Return (timestamps, values) of the last n samples, oldest first '''
+        t, v, _ = self.since(self.count - n)
+        return t, v
+
+    def window(self, n):
+        '''
+        (timestamps, values) of the last n samples as views into the buffer
+        (mirror only): no copy, but the writer overwrites them after another
+        size - n samples, so copy what has to be kept.
+        '''
+        stop = self.count
+        n = max(min(n, stop, stop + self.size - self.reserved), 0)     # Not the slots the writer fills next
+        start = (stop - n) % self.size
+        return self.time[start:start + n], self.data[start:start + n]
+
+    def last(self):
+        ''' Return (timestamp, value) of the most recent sample, or None '''
+        t, v = self.latest(1)
+        if len(t) == 0:
+            return None
+        return t[0], v[0]
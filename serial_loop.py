@@ -0,0 +1,405 @@
+'''
+One thread driving many serial devices: requests, replies and timeouts
+Aug 2016
+
+The USB boards answer a command with one line. Instead of a blocking
+write + readline per device (and a thread per device, stalled for the
+whole serial timeout when a reply goes missing), every device is a
+SerialChannel of one SerialLoop. A request writes the command right away
+and returns a Reply (a future); the loop thread select()s on all the
+ports, collects partial lines until they are complete, and hands every
+line to the oldest pending request of its channel.
+
+A request that gets no reply within its timeout fails with ReplyTimeout.
+Its slot stays in the queue for another timeout, so a late reply is
+dropped instead of being taken for the answer to the next command. Lines
+nobody asked for go to the channel's unsolicited callback, if any. If a
+port fails (read error, e.g. the device was unplugged, or end of file),
+its channel is taken off the loop and everything pending on it fails;
+the other channels carry on. Errors in callbacks and timers are printed
+and do not stop the loop either.
+
+Usage:
+    loop = SerialLoop()
+    counter = loop.open('/dev/ttyACM0')
+    power = loop.open('/dev/ttyACM1', write_terminator=';')
+    loop.start()
+    counts, volt = counter.request('COUNTS?'), power.request('VOLT?')
+    print(counts.result(), volt.result())   # Both devices worked at the same time
+
+The device classes (CQTdevices, Counter.Countercomm) take the loop as an
+optional argument, e.g. AnalogComm(port, loop=loop); the loop must be
+running already, since they talk to the device when they are created.
+Their methods still block for the reply, _query_async() does not.
+
+The boards read commands while they are busy, so several queries can go
+out in one write, e.g. 'IN?0;IN?1;ALLIN?', with their replies matched in
+order: channel.request_many() or a device's _query_pipelined(). That is
+one USB round trip instead of one per command.
+
+Linux only (select on the device nodes).
+'''
+
+import collections
+import heapq
+import itertools
+import os
+import select
+import threading
+import traceback
+
+import serial
+
+from clock import monotonic
+
+
+class ReplyTimeout(IOError):
+    pass
+
+
+class Reply(object):
+    ''' The future reply (a string without line ending) to a command, and when it came (monotonic) '''
+
+    def __init__(self, command):
+        self.command = command
+        self.value = None
+        self.error = None
+        self.time = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def done(self):
+        return self.event.is_set()
+
+    def _finish(self, value=None, error=None):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.value = value
+            self.error = error
+            self.time = monotonic()
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def set_result(self, value):
+        self._finish(value=value)
+
+    def set_exception(self, error):
+        self._finish(error=error)
+
+    def add_done_callback(self, callback):
+        ''' callback(reply) once done, on the loop thread (or right now if already done) '''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        # A failing callback must not take down the loop thread (or the other callbacks)
+        try:
+            callback(self)
+        except Exception:
+            traceback.print_exc()
+
+    def result(self, timeout=None):
+        ''' Wait for the reply and return it, or raise its error '''
+        if not self.event.wait(timeout):
+            raise ReplyTimeout('No reply to %r yet' % self.command)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SerialChannel(object):
+    '''
+    One serial device of a SerialLoop. Commands are written with
+    write_terminator appended; replies are lines ending with a line feed
+    (the carriage return and other trailing whitespace are stripped).
+    '''
+
+    def __init__(self, loop, port, write_terminator='\n', timeout=1.):
+        self.loop = loop
+        self.serial = port
+        self.fd = port.fileno()
+        self.write_terminator = write_terminator
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # Writes may block: they don't hold lock, so the loop keeps reading
+        self.pending = collections.deque()  # [reply, deadline, expired], oldest first
+        self.buffer = b''
+        self.unsolicited = None             # Called with every line nobody asked for
+        self.late = 0                       # Replies that came after their timeout
+        self.dropped = 0                    # Lines nobody asked for, without an unsolicited callback
+        self.error = None                   # Why the channel stopped (read error or end of file), if it did
+
+    def _encode(self, command):
+        data = command + self.write_terminator
+        return data if isinstance(data, bytes) else data.encode('utf-8')
+
+    def send(self, command):
+        ''' Write a command that has no reply '''
+        with self.write_lock:
+            self.serial.write(self._encode(command))
+
+    def request(self, command, timeout=None):
+        ''' Write a command and return the Reply to it '''
+        return self.request_many([command], timeout)[0]
+
+    def request_many(self, commands, timeout=None):
+        '''
+        Write several commands (each with a one line reply) in one go,
+        returns their Replies in the same order. The timeout is for the
+        whole batch.
+        '''
+        replies = [Reply(command) for command in commands]
+        deadline = monotonic() + (self.timeout if timeout is None else timeout)
+        with self.write_lock:
+            with self.lock:
+                if self.error is not None:
+                    raise IOError('Channel stopped: %s' % self.error)
+                self.pending.extend([[reply, deadline, False] for reply in replies])
+            self.serial.write(self._encode(self.write_terminator.join(commands)))
+        return replies
+
+    def reset(self):
+        ''' Forget the replies in flight (they fail) and whatever is in the input buffers '''
+        with self.lock:
+            pending, self.pending = self.pending, collections.deque()
+            self.buffer = b''
+            self.serial.reset_input_buffer()
+        for reply, deadline, expired in pending:
+            reply.set_exception(IOError('Channel reset'))
+
+    def _readable(self):
+        # Called by the loop: take what has arrived and complete the requests of the full lines
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:     # e.g. EIO once the device is unplugged
+            self._fail(e)
+            return
+        if not data:
+            self._fail(IOError('End of file'))
+            return
+        finished = []
+        with self.lock:
+            self.buffer += data
+            lines = self.buffer.split(b'\n')
+            self.buffer = lines.pop()       # Partial line, if any
+            for line in lines:
+                line = line.rstrip()
+                if bytes is not str:
+                    line = line.decode('utf-8', 'replace')
+                if not self.pending:
+                    finished.append((None, line))
+                    continue
+                reply, deadline, expired = self.pending.popleft()
+                if expired:
+                    self.late += 1
+                else:
+                    finished.append((reply, line))
+        for reply, line in finished:
+            if reply is not None:
+                reply.set_result(line)
+            elif self.unsolicited is not None:
+                self.unsolicited(line)
+            else:
+                self.dropped += 1
+
+    def _fail(self, error):
+        # Called by the loop: the device is gone. Stop serving it and fail whatever waits for it
+        self.loop.remove(self)
+        with self.lock:
+            self.error = error
+            pending, self.pending = self.pending, collections.deque()
+        for reply, deadline, expired in pending:
+            reply.set_exception(IOError('Channel stopped: %s' % error))
+
+    def _expire(self, now):
+        # Called by the loop: fail the requests past their deadline, forget the slots of long lost replies
+        expired = []
+        with self.lock:
+            for entry in self.pending:
+                if not entry[2] and now > entry[1]:
+                    entry[2] = True
+                    entry[1] = now + self.timeout   # How long a late reply is still expected
+                    expired.append(entry[0])
+            while self.pending and self.pending[0][2] and now > self.pending[0][1]:
+                self.pending.popleft()
+        for reply in expired:
+            reply.set_exception(ReplyTimeout('No reply to %r' % reply.command))
+
+    def next_deadline(self):
+        # When _expire has something to do: a request timing out, or the slot at the head given up
+        with self.lock:
+            deadlines = [entry[1] for entry in self.pending if not entry[2]]
+            if self.pending and self.pending[0][2]:
+                deadlines.append(self.pending[0][1])
+        return min(deadlines) if deadlines else None
+
+    def close(self):
+        self.loop.remove(self)
+        self.serial.close()
+
+
+class SerialLoop(object):
+    '''
+    The thread serving all the channels. call_later() runs a function on
+    that thread after a delay, e.g. to poll a device periodically.
+    '''
+    MAX_WAIT = 0.5
+
+    def __init__(self):
+        self.channels = {}      # fd: channel
+        self.timers = []        # heap of (time, sequence, function, args)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        self.running = 0
+        self.thread = None
+
+    def open(self, port, baudrate=115200, write_terminator='\n', timeout=1.):
+        ''' Open a serial port as a new channel '''
+        return self.add(serial.Serial(port, baudrate, timeout=0), write_terminator, timeout)
+
+    def add(self, port, write_terminator='\n', timeout=1.):
+        ''' Serve an already open serial port as a new channel '''
+        channel = SerialChannel(self, port, write_terminator, timeout)
+        self.attach(channel)
+        return channel
+
+    def attach(self, channel):
+        ''' Serve a channel (again, after remove()) '''
+        with self.lock:
+            self.channels[channel.fd] = channel
+        self._wake()
+
+    def remove(self, channel):
+        with self.lock:
+            self.channels.pop(channel.fd, None)
+        self._wake()
+
+    def call_later(self, delay, function, *args):
+        with self.lock:
+            heapq.heappush(self.timers, (monotonic() + delay, next(self.sequence), function, args))
+        self._wake()
+
+    def _wake(self):
+        if self.running:
+            os.write(self.wake_write, b'x')
+
+    def start(self):
+        self.running = 1
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = 0
+        os.write(self.wake_write, b'x')
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                channels = list(self.channels.values())
+                deadlines = [self.timers[0][0]] if self.timers else []
+            deadlines += [d for d in [channel.next_deadline() for channel in channels] if d is not None]
+            wait = self.MAX_WAIT
+            if deadlines:
+                wait = min(max(min(deadlines) - monotonic(), 0), wait)
+
+            try:
+                readable, _, _ = select.select([self.wake_read] + [channel.fd for channel in channels], [], [], wait)
+            except (select.error, OSError, ValueError):
+                continue    # A port closed meanwhile, it is gone from channels by now
+            for fd in readable:
+                if fd == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                elif fd in self.channels:
+                    self.channels[fd]._readable()
+
+            now = monotonic()
+            for channel in channels:
+                channel._expire(now)
+            while True:
+                with self.lock:
+                    if not self.timers or self.timers[0][0] > now:
+                        break
+                    when, sequence, function, args = heapq.heappop(self.timers)
+                try:
+                    function(*args)
+                except Exception:
+                    traceback.print_exc()
+
+
+class LoopDevice(object):
+    '''
+    Request helpers for the device classes (CQTdevices, Counter). A device
+    opened with a SerialLoop talks through its SerialChannel; otherwise
+    through its own blocking _serial_write and _serial_read, as before.
+    '''
+    loop_channel = None
+    REPLY_MARGIN = 1.       # s
+    separator = '\n'       # Between pipelined commands (the boards with a ';' terminator accept it too)
+
+    def _open_channel(self, loop, port, write_terminator, timeout):
+        self.loop_channel = loop.open(port, self.baudrate, write_terminator, timeout)
+        return self.loop_channel.serial
+
+    def _close(self):
+        if self.loop_channel is not None:
+            self.loop_channel.close()
+        else:
+            self.serial.close()
+
+    def _send(self, command):
+        ''' Write a command that has no reply '''
+        if self.loop_channel is not None:
+            self.loop_channel.send(command)
+        else:
+            self._serial_write(command)
+
+    def _send_pipelined(self, commands):
+        ''' Write several commands without replies in one go '''
+        self._send(self.separator.join(commands))
+
+    def _query_async(self, command, timeout=None):
+        ''' Write a command, returns the Reply (already done without a loop) '''
+        if self.loop_channel is not None:
+            return self.loop_channel.request(command, timeout)
+        self._serial_write(command)
+        reply = Reply(command)
+        reply.set_result(self._serial_read())
+        return reply
+
+    def _query_pipelined(self, commands, timeout=None):
+        '''
+        Write several commands (all with a reply) in one go, returns their
+        Replies in order. Without a loop the replies are read right away
+        ('' for a reply that timed out).
+        '''
+        if self.loop_channel is not None:
+            return self.loop_channel.request_many(commands, timeout)
+        self._serial_write(self.separator.join(commands))
+        replies = [Reply(command) for command in commands]
+        for reply in replies:
+            reply.set_result(self._serial_read())
+        return replies
+
+    def _query(self, command, timeout=None):
+        ''' Write a command and wait for its reply, '' if it timed out (like readline) '''
+        reply = self._query_async(command, timeout)
+        if self.loop_channel is not None:
+            # The loop fails the request after its timeout; the margin only matters if the loop is stuck
+            timeout = self.loop_channel.timeout if timeout is None else timeout
+            timeout += self.REPLY_MARGIN
+        try:
+            return reply.result(timeout)
+        except ReplyTimeout:
+            return ''
@@ -0,0 +1,107 @@
+'''
+Filters between the counter acquisition and the lock logic
+Aug 2016
+
+All filters read from a ringbuffer.RingBuffer and use the sample timestamps,
+so their time constant does not depend on the gate time or on how fast the
+serial port delivers. Each filter reports its effective latency in seconds
+(time constant for the EMA, group delay for the window filters), which the
+lock uses to decide how long to wait for a correction to show up.
+
+Usage:
+    filt = make_filter('ema', tau=0.5)
+    value = filt.update(buffer)     # Once per tick
+'''
+
+import numpy as np
+
+
+class EMAFilter(object):
+    '''
+    Exponential moving average with a time constant tau (s). Irregularly
+    spaced samples are weighted by exp(-dt/tau), computed in one shot over
+    all the samples that arrived since the last update.
+    '''
+
+    def __init__(self, tau=0.5):
+        self.tau = float(tau)
+        self.latency = self.tau
+        self.value = 0.
+        self.last_time = None
+        self.cursor = 0
+
+    def update(self, buffer):
+        t, x, self.cursor = buffer.since(self.cursor)
+        if len(t) == 0:
+            return self.value
+        if self.last_time is None:
+            # First sample initialises the average
+            self.value = float(x[0])
+            self.last_time = t[0]
+        # Sample i has weight (1 - exp(-dt_i/tau)) * exp(-(t_N - t_i)/tau), which is
+        # the difference of consecutive decays exp(-(t_N - t)/tau) over [last_time, t]
+        decay = np.exp((np.concatenate(([self.last_time], t)) - t[-1])/self.tau)
+        self.value = float(decay[0]*self.value + np.dot(np.diff(decay), x))
+        self.last_time = t[-1]
+        return self.value
+
+
+class WindowFilter(object):
+    '''
+    Base for filters over the samples of the last `window` seconds.
+    '''
+
+    def __init__(self, window=0.5):
+        self.window = float(window)
+        self.latency = self.window/2
+        self.value = 0.
+
+    def _window(self, buffer):
+        t, x = buffer.latest(buffer.size)
+        if len(t) == 0:
+            return x
+        return x[np.searchsorted(t, t[-1] - self.window, side='right'):]
+
+    def update(self, buffer):
+        x = self._window(buffer)
+        if len(x):
+            self.value = self._reduce(x)
+        return self.value
+
+
+class MeanFilter(WindowFilter):
+    ''' Plain mean over the window '''
+
+    def _reduce(self, x):
+        return float(np.mean(x))
+
+
+class MedianFilter(WindowFilter):
+    ''' Median over the window, insensitive to single spikes '''
+
+    def _reduce(self, x):
+        return float(np.median(x))
+
+
+class OutlierFilter(WindowFilter):
+    '''
+    Mean over the window after rejecting samples more than `nsigma`
+    robust standard deviations (1.4826 * MAD) away from the median.
+    '''
+
+    def __init__(self, window=0.5, nsigma=3.):
+        WindowFilter.__init__(self, window)
+        self.nsigma = nsigma
+
+    def _reduce(self, x):
+        median = np.median(x)
+        sigma = 1.4826*np.median(np.abs(x - median))
+        if sigma == 0:
+            return float(median)
+        return float(np.mean(x[np.abs(x - median) <= self.nsigma*sigma]))
+
+
+FILTERS = {'ema': EMAFilter, 'mean': MeanFilter, 'median': MedianFilter, 'outlier': OutlierFilter}
+
+def make_filter(name, **kwargs):
+    return FILTERS[name](**kwargs)
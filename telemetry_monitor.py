@@ -0,0 +1,31 @@
+'''
+Prints the telemetry the retreat controller broadcasts every tick.
+Subscribing costs the controller nothing, so run as many of these as you like.
+
+Every message is the topic "telemetry" followed by a JSON object with:
+- time, tick: monotonic time (s) and number of the tick
+- counts: filtered counts used by the lock
+- samples: {"time": [...], "counts": [...]}, the raw counter samples since the last tick
+- output, set: output and set voltages of channels 1 to 6
+- offset_adj: lock offsets added to V5 and V6
+- set_lock_status, lock_process, lock_target: see the GUI
+- timing: {"jitter", "duration"} of the last tick in s, and the scheduler's "overruns" and "skipped"
+'''
+
+
+import zmq
+import json
+
+context = zmq.Context()
+
+#  Socket to listen to the server
+print "Subscribing to the retreat controller telemetry"
+socket = context.socket(zmq.SUB)
+socket.connect("tcp://localhost:5557")
+socket.setsockopt(zmq.SUBSCRIBE, "telemetry")
+
+while True:
+    topic, message = socket.recv_multipart()
+    telemetry = json.loads(message)
+    print "Tick", telemetry["tick"], ": counts", round(telemetry["counts"], 2), "(%d samples)" % len(telemetry["samples"]["counts"]), \
+        "| outputs", ' '.join(['%.3f' % v for v in telemetry["output"]]), "| lock", telemetry["lock_process"]
@@ -0,0 +1,56 @@
+'''
+Limits of the ramps of trajectory.py, with the limits of the retreat controller
+Run with: python -m unittest test_trajectory
+'''
+
+import unittest
+import numpy as np
+
+from trajectory import plan_trajectory
+
+# (max velocity V/s, max acceleration V/s^2, max jerk V/s^3), as V1-V4 and V5-V6 of the
+# controller, written as ints on purpose: the limits must not be truncated by int division
+LIMITS = [(1, 2, 10), (0.5, 1, 5)]
+MOVES = [(0, 5), (5, 0), (-2, 3.3), (0, 0.25), (1, 1.17)]     # More than one step (a single step is left as is)
+DT = 0.1
+
+
+def derivatives(points, start, dt):
+    # Velocity, acceleration and jerk of the ramp, starting and ending at rest
+    positions = np.concatenate([[start] * 3, points, [points[-1]] * 3])
+    velocity = np.diff(positions) / dt
+    acceleration = np.diff(velocity) / dt
+    jerk = np.diff(acceleration) / dt
+    return velocity, acceleration, jerk
+
+
+class TrajectoryLimits(unittest.TestCase):
+
+    def check(self, profile, limited):
+        for limits in LIMITS:
+            for start, end in MOVES:
+                points = plan_trajectory(profile, start, end, limits[0], DT, limits[1], limits[2])
+                self.assertAlmostEqual(points[-1], end)
+                for name, values, limit in list(zip(('velocity', 'acceleration', 'jerk'),
+                                                     derivatives(points, start, DT), limits))[:limited]:
+                    self.assertLessEqual(np.abs(values).max(), limit * (1 + 1e-9),
+                                         '%s %s of %s to %s: %g > %g' % (profile, name, start, end, np.abs(values).max(), limit))
+
+    def test_linear(self):
+        self.check('linear', 1)
+
+    def test_scurve(self):
+        self.check('scurve', 2)
+
+    def test_jerk(self):
+        self.check('jerk', 3)
+
+    def test_nothing_to_do(self):
+        self.assertEqual(len(plan_trajectory('jerk', 1., 1., 1., DT, 2., 10.)), 0)
+
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, plan_trajectory, 'cubic', 0., 1., 1., DT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,11 @@ while i<100:
 
 print("--- %s seconds ---" % (time.time() - start_time))
 
+# Readings of all inputs per second, one channel at a time vs ALLIN?
+from CQTdevices import analog_rates
+for name, rate in sorted(analog_rates(apm).items()):
+	print "%-14s %7.1f /s" % (name, rate)
+
 apm._serial_write("OFF")
 apm.close()
 print "Analog powermeter has turned off."
\ No newline at end of file
@@ -0,0 +1,64 @@
+'''
+Voltage ramps planned as a whole, for the VoltageHandler of the retreat controller
+Aug 2016
+
+A ramp from start to end is sampled every dt and returned as the array of
+the voltages at dt, 2dt, ... (the last one is exactly end). Profiles:
+- linear: constant slew at max_velocity (the staircase the controller always did)
+- scurve: the velocity ramps up and down at max_acceleration (S-shaped voltage)
+- jerk: as scurve, but the acceleration itself ramps at max_jerk
+
+The smooth profiles are the linear velocity profile smoothed by moving
+averages: one of duration max_velocity/max_acceleration for scurve, then
+another of duration max_acceleration/max_jerk for jerk. Averaging keeps
+the distance and never increases the velocity, and every average bounds
+the next derivative, so all the limits hold by construction. The price is
+the ramp up/down time added to the move.
+'''
+
+from __future__ import division
+
+import math
+import numpy as np
+
+PROFILES = ('linear', 'scurve', 'jerk')
+
+
+def _box(duration, dt):
+    # Moving average over duration (at least one sample)
+    n = max(1, int(math.ceil(duration / dt - 1e-9)))
+    return np.ones(n) / n
+
+
+def plan_trajectory(profile, start, end, max_velocity, dt, max_acceleration=None, max_jerk=None):
+    ''' Voltages at dt, 2dt, ... of a ramp from start to end (empty if there is nothing to do) '''
+    if profile not in PROFILES:
+        raise ValueError("Unknown ramp profile %r, use one of %s" % (profile, ', '.join(PROFILES)))
+    distance = abs(end - start)
+    if distance == 0:
+        return np.zeros(0)
+    step = max_velocity * dt
+
+    # Linear: full steps and whatever is left
+    full = int(distance // step)
+    steps = [step] * full
+    if distance - full * step > 1e-12:
+        steps.append(distance - full * step)
+    steps = np.array(steps)
+
+    if profile in ('scurve', 'jerk') and len(steps) > 1:
+        accel_box = _box(max_velocity / max_acceleration, dt)
+        if profile == 'jerk':
+            jerk_box = _box(max_acceleration / max_jerk, dt)
+            # Short moves: spread the steps so that the accelerating and
+            # braking phases never meet within a jerk ramp (lower velocity)
+            minimum = len(accel_box) + len(jerk_box)
+            if len(steps) < minimum:
+                steps = np.ones(minimum) * distance / minimum
+            steps = np.convolve(np.convolve(steps, accel_box), jerk_box)
+        else:
+            steps = np.convolve(steps, accel_box)
+
+    points = start + math.copysign(1, end - start) * np.cumsum(steps)
+    points[-1] = end
+    return points